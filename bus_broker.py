@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+RS485 bus broker: one process owns the serial adapter, several Domoticz
+plugins (or any Modbus TCP master) share it through a local socket.
+
+    python3 bus_broker.py --port /dev/ttyUSB1 [--baud 9600] [--listen 127.0.0.1:5020]
+
+The clients connect to the broker as to a Modbus TCP gateway, the RTD-W
+plugin with "Modbus Port" broker://127.0.0.1:5020. The requests of all the
+clients go through a single scheduler in front of the serial line:
+    priority    writes first, then the reads by the priority given in the
+                MBAP protocol identifier: 1 fast, 2 normal, 3 slow. Other
+                Modbus TCP masters send 0, read as normal.
+    fairness    the clients with requests of the same priority are served in
+                turn, a client polling a lot does not delay the others.
+    coalescing  a read of holding or input registers already covered by a
+                queued read of the same slave is answered from that frame.
+The answers of a client can come back out of order, they are matched by
+transaction id. A slave that does not answer, or answers with a bad CRC, is
+reported with exception 11 (gateway target device failed to respond).
+"""
+
+import argparse
+import collections
+import itertools
+import socket
+import struct
+import threading
+import time
+
+import serial
+
+
+WRITE = 0
+FAST = 1
+NORMAL = 2
+SLOW = 3
+PRIORITIES = (WRITE, FAST, NORMAL, SLOW)
+
+WRITES = (5, 6, 15, 16, 22, 23)
+REGISTER_READS = (3, 4)
+GATEWAY_NO_RESPONSE = 11
+# Seconds a client may leave its answers unread before it is dropped: the
+# answers are sent by the bus thread, a stuck client must not hold the bus
+SEND_TIMEOUT = 1.0
+
+
+def crcTable():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = crcTable()
+
+
+def crc16(frame):
+    crc = 0xFFFF
+    for byte in frame:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return struct.pack("<H", crc)
+
+
+class Request:
+    """
+        One frame for the serial line. waiters are the client requests it
+        answers: (client, transaction, protocol, offset, count), offset and
+        count in registers for a coalesced read, None otherwise.
+    """
+    __slots__ = ("client", "slave", "pdu", "priority", "functioncode", "start", "count", "waiters", "queued")
+
+    def __init__(self, client, slave, pdu, priority, transaction, protocol):
+        self.client = client
+        self.slave = slave
+        self.pdu = pdu
+        self.priority = priority
+        self.functioncode = pdu[0]
+        self.start = self.count = None
+        if self.functioncode in REGISTER_READS and len(pdu) == 5:
+            self.start, self.count = struct.unpack(">HH", pdu[1:5])
+        self.waiters = [(client, transaction, protocol, None, None)]
+        self.queued = time.monotonic()
+
+    def covers(self, other):
+        return (self.start is not None and other.start is not None and self.slave == other.slave
+                and self.functioncode == other.functioncode
+                and self.start <= other.start and other.start + other.count <= self.start + self.count)
+
+
+class Scheduler:
+    """
+        Queues of requests by priority, then by client. next() blocks until a
+        request is ready and returns the oldest request of the client served
+        least recently at the highest priority waiting. A read rises one
+        priority every aging seconds in the queue, so a busy fast client
+        cannot starve the slow polls.
+    """
+
+    def __init__(self, aging=1.0):
+        self.aging = aging
+        self.condition = threading.Condition()
+        self.queues = [collections.OrderedDict() for priority in PRIORITIES]
+        self.turns = itertools.count()
+        self.served = {}
+        self.stopping = False
+        self.submitted = 0
+        self.coalesced = 0
+
+    def submit(self, request):
+        with self.condition:
+            self.submitted += 1
+            if request.start is not None:
+                queued = self.find(request)
+                if queued is not None:
+                    client, transaction, protocol, offset, count = request.waiters[0]
+                    queued.waiters.append((client, transaction, protocol, request.start - queued.start, request.count))
+                    self.coalesced += 1
+                    if request.priority < queued.priority:
+                        self.move(queued, request.priority)
+                    return
+            self.queues[request.priority].setdefault(request.client, collections.deque()).append(request)
+            self.condition.notify()
+
+    def find(self, request):
+        for queue in self.queues:
+            for requests in queue.values():
+                for queued in requests:
+                    if queued.covers(request):
+                        return queued
+        return None
+
+    def move(self, request, priority):
+        # A faster client waits on a slower read: the read moves up
+        requests = self.queues[request.priority][request.client]
+        requests.remove(request)
+        if not requests:
+            del self.queues[request.priority][request.client]
+        request.priority = priority
+        self.queues[priority].setdefault(request.client, collections.deque()).append(request)
+
+    def next(self):
+        with self.condition:
+            while not self.stopping:
+                chosen = None
+                now = time.monotonic()
+                for priority, queue in enumerate(self.queues):
+                    if queue:
+                        # Aging: a read waiting aging seconds goes up one priority, writes stay first
+                        oldest = min(requests[0].queued for requests in queue.values())
+                        rank = priority
+                        if priority > FAST:
+                            rank = max(FAST, priority - int((now - oldest) / self.aging))
+                        if chosen is None or (rank, oldest) < chosen[:2]:
+                            chosen = (rank, oldest, queue)
+                if chosen is not None:
+                    queue = chosen[2]
+                    client = min(queue, key=lambda client: self.served.get(client, -1))
+                    requests = queue[client]
+                    request = requests.popleft()
+                    if not requests:
+                        del queue[client]
+                    self.served[client] = next(self.turns)
+                    return request
+                self.condition.wait()
+            return None
+
+    def drop(self, client):
+        # Forget a disconnected client, its reads still answer the others
+        with self.condition:
+            for queue in self.queues:
+                for owner in list(queue):
+                    kept = collections.deque()
+                    for request in queue[owner]:
+                        request.waiters = [waiter for waiter in request.waiters if waiter[0] is not client]
+                        if request.waiters:
+                            kept.append(request)
+                    if kept:
+                        queue[owner] = kept
+                    else:
+                        del queue[owner]
+            self.served.pop(client, None)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+
+class SerialBus:
+    """
+        Modbus RTU master on the serial port, one transaction at a time with
+        the 3.5 character silence of the protocol between frames.
+    """
+
+    def __init__(self, port, baudrate=9600, parity="N", timeout=1.0):
+        self.serial = serial.serial_for_url(port, baudrate=baudrate, bytesize=8, parity=parity, stopbits=1,
+                                            timeout=timeout)
+        self.silence = max(0.00175, 3.5 * 11 / baudrate)
+        self.last = 0.0
+        self.frames = 0
+        self.timeouts = 0
+        self.crcErrors = 0
+        self.busy = 0.0
+
+    def close(self):
+        self.serial.close()
+
+    def transact(self, slave, pdu):
+        """ Answer PDU of the slave, None if it does not answer properly """
+        frame = bytes([slave]) + pdu
+        wait = self.last + self.silence - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        start = time.monotonic()
+        self.serial.reset_input_buffer()
+        self.serial.write(frame + crc16(frame))
+        self.frames += 1
+        answer = self.receive()
+        self.last = time.monotonic()
+        self.busy += self.last - start
+        return answer
+
+    def receive(self):
+        header = self.serial.read(3)
+        if len(header) < 3:
+            self.timeouts += 1
+            return None
+        if header[1] & 0x80:
+            length = 2
+        elif header[1] in (1, 2, 3, 4):
+            length = header[2] + 2
+        else:
+            length = 5
+        body = self.serial.read(length)
+        frame = header + body
+        if len(body) < length:
+            self.timeouts += 1
+            return None
+        if crc16(frame[:-2]) != frame[-2:]:
+            self.crcErrors += 1
+            return None
+        return frame[1:-2]
+
+
+class Client:
+    """
+        A client connection, answers are sent by the bus thread. send() returns
+        False once a send failed or timed out, the client is then dropped.
+    """
+
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.closed = False
+
+    def send(self, transaction, protocol, slave, pdu):
+        frame = struct.pack(">HHHB", transaction, protocol, len(pdu) + 1, slave) + pdu
+        with self.lock:
+            if self.closed:
+                return False
+            try:
+                self.connection.sendall(frame)
+            except OSError:
+                self.closed = True
+                return False
+        return True
+
+
+class Broker:
+    """
+        Modbus TCP server in front of a SerialBus. One thread per client reads
+        the requests, one bus thread runs them in the order of the scheduler.
+    """
+
+    def __init__(self, bus, host="127.0.0.1", port=5020):
+        self.bus = bus
+        self.scheduler = Scheduler()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.listener.settimeout(0.1)
+        self.port = self.listener.getsockname()[1]
+        self.url = "broker://{}:{}".format(host, self.port)
+        self.stopping = threading.Event()
+        self.clients = []
+        self.clientsLock = threading.Lock()
+        self.waits = [[0, 0.0, 0.0] for priority in PRIORITIES]
+        self.threads = [threading.Thread(name="broker accept", target=self.accept, daemon=True),
+                        threading.Thread(name="broker bus", target=self.run, daemon=True)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.scheduler.stop()
+        for thread in self.threads:
+            thread.join()
+        self.listener.close()
+        with self.clientsLock:
+            clients = list(self.clients)
+        for client in clients:
+            self.disconnect(client)
+
+    def accept(self):
+        while not self.stopping.is_set():
+            try:
+                connection, address = self.listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            connection.settimeout(SEND_TIMEOUT)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = Client(connection, address)
+            with self.clientsLock:
+                self.clients.append(client)
+            threading.Thread(name="broker client", target=self.serve, args=(client,), daemon=True).start()
+
+    def disconnect(self, client):
+        self.scheduler.drop(client)
+        try:
+            client.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.connection.close()
+        with self.clientsLock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def serve(self, client):
+        buffer = b""
+        try:
+            while not self.stopping.is_set():
+                try:
+                    data = client.connection.recv(4096)
+                except socket.timeout:
+                    # The timeout is there for the sends, a quiet client is fine
+                    continue
+                if not data:
+                    break
+                buffer += data
+                while len(buffer) >= 7:
+                    transaction, protocol, length, slave = struct.unpack(">HHHB", buffer[:7])
+                    # Unit id and function code at least, 253 bytes of PDU at most:
+                    # past that the stream is out of step and cannot be resynced
+                    if not 2 <= length <= 254:
+                        return
+                    if len(buffer) < 6 + length:
+                        break
+                    pdu, buffer = buffer[7:6 + length], buffer[6 + length:]
+                    client.requests += 1
+                    self.scheduler.submit(Request(client, slave, pdu, self.priority(protocol, pdu), transaction, protocol))
+        except OSError:
+            pass
+        finally:
+            self.disconnect(client)
+
+    @staticmethod
+    def priority(protocol, pdu):
+        if pdu and pdu[0] in WRITES:
+            return WRITE
+        if protocol in (FAST, NORMAL, SLOW):
+            return protocol
+        return NORMAL
+
+    def run(self):
+        while True:
+            request = self.scheduler.next()
+            if request is None:
+                break
+            wait = time.monotonic() - request.queued
+            stats = self.waits[request.priority]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+            try:
+                answer = self.bus.transact(request.slave, request.pdu)
+            except (OSError, serial.SerialException):
+                answer = None
+            for client, transaction, protocol, offset, count in request.waiters:
+                if answer is None:
+                    pdu = bytes([request.functioncode | 0x80, GATEWAY_NO_RESPONSE])
+                elif offset is None or answer[0] & 0x80:
+                    pdu = answer
+                else:
+                    pdu = bytes([answer[0], 2 * count]) + answer[2 + 2 * offset:2 + 2 * (offset + count)]
+                if not client.send(transaction, protocol, request.slave, pdu):
+                    self.disconnect(client)
+
+    def stats(self):
+        return {
+            "clients": len(self.clients),
+            "requests": self.scheduler.submitted,
+            "coalesced": self.scheduler.coalesced,
+            "frames": self.bus.frames,
+            "timeouts": self.bus.timeouts,
+            "crc_errors": self.bus.crcErrors,
+            "bus_busy_s": round(self.bus.busy, 3),
+            "wait_ms": dict((priority, (round(1000 * total / count, 1) if count else 0.0, round(1000 * longest, 1)))
+                            for priority, (count, total, longest) in zip(("write", "fast", "normal", "slow"), self.waits)),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share an RS485 Modbus adapter between several Modbus TCP clients")
+    parser.add_argument("--port", required=True, help="serial port of the RS485 adapter (pyserial URL)")
+    parser.add_argument("--baud", type=int, default=9600)
+    parser.add_argument("--parity", choices=("N", "E", "O"), default="N")
+    parser.add_argument("--timeout", type=float, default=1.0, help="answer timeout of the slaves, seconds")
+    parser.add_argument("--listen", default="127.0.0.1:5020", help="address:port of the client socket")
+    parser.add_argument("--stats", type=float, default=0, help="print the statistics every STATS seconds")
+    args = parser.parse_args()
+
+    host, port = args.listen.rsplit(":", 1)
+    broker = Broker(SerialBus(args.port, args.baud, args.parity, args.timeout), host, int(port)).start()
+    print("RS485 bus broker on {} for {} (Ctrl-C to stop)".format(broker.url, args.port))
+    try:
+        while True:
+            time.sleep(args.stats or 1)
+            if args.stats:
+                print(broker.stats())
+    except KeyboardInterrupt:
+        pass
+    broker.stop()
+    broker.bus.close()
+    print(broker.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -14,20 +14,31 @@ Requirements:
     small inverter chillers (EWA/YQ16..64 series) and VRV heating only hydrobox.
     The interface is compatible with all units that are operated using a BRC21 remote controller network
     connection and allows control of up to 16 units in a single group.
-    Note: this plugin is intended for a single RTD-W at address 1, with a single unit.
+    Note: this plugin is intended for a single RTD-W at address 1. The units of the group are found with
+    the PCB count (I0020), the temperatures of each unit after the first one get their own devices.
 """
 
 """
-<plugin key="RTD-W" name="DAIKIN ALTHERMA HT (RTD-W Modbus)" version="0.1.3" author="Vincent835">
+<plugin key="RTD-W" name="DAIKIN ALTHERMA HT (RTD-W Modbus)" version="0.3.3" author="Vincent835">
     <params>
-        <param field="SerialPort" label="Modbus Port" width="200px" required="true" default="/dev/ttyUSB1" />
-        <param field="Mode1" label="Baud rate" width="40px" required="true" default="9600"  />
+        <param field="SerialPort" label="Modbus Port (or tcp://host:port, rtutcp://host:port, broker://host:port)" width="200px" required="true" default="/dev/ttyUSB1" />
+        <param field="Mode1" label="Baud rate (or auto)" width="40px" required="true" default="9600"  />
         <param field="Mode2" label="Device ID" width="40px" required="true" default="1" />
         <param field="Mode3" label="Reading Interval min." width="40px" required="true" default="1" />
+        <param field="Mode4" label="Export (mqtt://host/topic or influx://host:8086/database)" width="200px" />
+        <param field="Mode5" label="Equipment" width="200px">
+            <options>
+                <option label="Altherma HT hydrobox" value="altherma" default="true" />
+                <option label="EWA/YQ inverter chiller" value="ewyq_chiller" />
+                <option label="VRV heating only hydrobox" value="vrv_hydrobox" />
+            </options>
+        </param>
         <param field="Mode6" label="Debug" width="75px">
             <options>
                 <option label="True" value="Debug"/>
                 <option label="False" value="Normal"  default="true" />
+                <option label="Profile" value="Profile" />
+                <option label="Record frames" value="Record" />
             </options>
         </param>
     </params>
@@ -37,6 +48,26 @@ Requirements:
 import minimalmodbus
 import serial
 import Domoticz
+import array
+import base64
+import bisect
+import collections
+import cProfile
+import heapq
+import http.client
+import io
+import itertools
+import json
+import mmap
+import os
+import pstats
+import queue
+import socket
+import struct
+import threading
+import time
+import traceback
+import urllib.parse
 from enum import IntEnum, unique  # , auto
 
 
@@ -73,22 +104,1158 @@ class unit(IntEnum):
     DHW_Reheat = 22
     DHW_Storage = 23
     Pump_Running_Hour_Counter = 24 
+
+#   Derived values, see Metrics
+    Delta_T = 200
+    Compressor_Duty = 201
+    Compressor_Starts = 202
+    Defrosts = 203
+    Defrost_Duration = 204
+    DHW_Reheat_Duration = 205
+
+#   Bus statistics, see BusStats
+    Bus_Cycle = 210
+    Bus_Load = 211
+    Bus_Timeouts = 212
+    Bus_CRC_Errors = 213
+    Bus_Illegal_Requests = 214
+    Heartbeat_Overruns = 215
     
     
+class DeviceDef:
+    """
+        Device definition, see BasePlugin.__UNITS.
+        Without typeName the device is created with type, subtype and switchtype.
+        Nota : la description n'est pas associée au dispositif s'il est créé en UNUSED.
+    """
+    __slots__ = ("unit", "name", "typeName", "type", "subtype", "switchtype", "options", "used", "description")
+
+    def __init__(self, unit, name, typeName=None, type=0, subtype=0, switchtype=0, options=None, used=1, description=""):
+        self.unit = int(unit)
+        self.name = name
+        self.typeName = typeName
+        self.type = type
+        self.subtype = subtype
+        self.switchtype = switchtype
+        self.options = options or {}
+        self.used = used
+        self.description = description
+
+
+class RegisterDef:
+    """
+        Register definition, see BasePlugin.__REGISTERS.
+            unit        device of the register, the one updated after a write
+            address     register address, 0 based as in the manual
+            function    3 holding register, 4 input register
+            decimals    the value is divided by 10 ** decimals
+            signed      two's complement value
+            words       1, or 2 for a 32 bit value (R high word, R+1 low word)
+            period      poll tier: "watch", "fast", "normal", "slow" or "hourly"
+            decoder     value to (nValue, sValue), a key of DECODERS
+            encoder     command to value for a holding register, a key of ENCODERS
+            minimum, maximum    limits of the encoded value
+            targets     devices updated with the polled value, default [unit]
+            deadband    smallest change of the value worth a device update
+            refresh     devices read again after a write, see __FOLLOW_UPS, or
+                        after a change of state in the watch tier
+            plausible   (low, high) range of the valid values, see BlockDecoder
+            rate        largest change in a minute, a faster jump is dropped
+                        unless the next value confirms it (0: no limit)
+        decode and encode are set by CompileMap.
+    """
+    __slots__ = ("unit", "address", "function", "decimals", "signed", "words", "period", "decoder", "encoder",
+                 "minimum", "maximum", "targets", "deadband", "refresh", "plausible", "rate", "decode", "encode")
+
+    def __init__(self, unit, address, function=4, decimals=0, signed=False, words=1, period="normal",
+                 decoder="value", encoder=None, minimum=None, maximum=None, targets=None, deadband=0,
+                 refresh=(), plausible=None, rate=0):
+        self.unit = int(unit)
+        self.address = address
+        self.function = function
+        self.decimals = decimals
+        self.signed = signed
+        self.words = words
+        self.period = period
+        self.decoder = decoder
+        self.encoder = encoder
+        self.minimum = minimum
+        self.maximum = maximum
+        self.targets = tuple(int(target) for target in (targets if targets is not None else [unit]))
+        self.deadband = deadband
+        self.refresh = tuple(int(dependent) for dependent in refresh)
+        self.plausible = tuple(plausible) if plausible is not None else None
+        self.rate = rate
+        self.decode = None
+        self.encode = None
+
+
+class BlockDecoder:
+    """
+        Decoder of a block of a read plan, built once with the plan. The words
+        read are packed, then unpacked in a single call by a struct.Struct
+        (big endian, h/H for a register, i/I for a 32 bit pair, x over the
+        gaps) into the values of all the registers, which are then scaled and
+        checked:
+            "not available"     an input register holding 0x8000,
+            "implausible"       outside the plausible range of the register.
+        decode(words) returns (register, value, problem) for each register,
+        problem None for a valid value. Overlapping registers are unpacked
+        one by one.
+    """
+    __slots__ = ("registers", "pack", "unpack", "fields", "divisors", "sentinels", "ranges")
+
+    def __init__(self, start, count, registers):
+        self.registers = [register for register, offset in registers]
+        self.pack = struct.Struct(">{}H".format(count))
+        codes = []
+        self.fields = []
+        position = 0
+        for register, offset in registers:
+            code = ("h" if register.signed else "H") if register.words == 1 else ("i" if register.signed else "I")
+            self.fields.append((struct.Struct(">" + code), 2 * offset))
+            if codes is not None and offset >= position:
+                if offset > position:
+                    codes.append("{}x".format(2 * (offset - position)))
+                codes.append(code)
+                position = offset + register.words
+            else:
+                codes = None
+        self.unpack = struct.Struct(">" + "".join(codes)) if codes is not None else None
+        self.divisors = [(index, float(10 ** register.decimals)) for index, register in enumerate(self.registers)
+                         if register.decimals]
+        self.sentinels = [(index, -0x8000 if register.signed else 0x8000) for index, register in enumerate(self.registers)
+                          if register.words == 1 and register.function == 4]
+        self.ranges = [(index,) + register.plausible for index, register in enumerate(self.registers)
+                       if register.plausible is not None]
+
+    def decode(self, words):
+        data = self.pack.pack(*words)
+        if self.unpack is not None:
+            values = list(self.unpack.unpack_from(data))
+        else:
+            values = [field.unpack_from(data, offset)[0] for field, offset in self.fields]
+        problems = [None] * len(values)
+        for index, sentinel in self.sentinels:
+            if values[index] == sentinel:
+                problems[index] = "not available"
+        for index, divisor in self.divisors:
+            values[index] /= divisor
+        for index, low, high in self.ranges:
+            if problems[index] is None and not low <= values[index] <= high:
+                problems[index] = "implausible"
+        return list(zip(self.registers, values, problems))
+
+
+class BusHealth:
+    """
+        Health of the RS485 link and of each register.
+        After a link failure only a single register probe is sent, at an
+        interval doubling from backoffMin up to backoffMax seconds. The devices
+        are marked as timed out after timedOutAfter failures in a row.
+        A register failing breakerFailures times in a row is not read for
+        breakerSeconds seconds (circuit breaker), then tried again once.
+    """
+
+    def __init__(self, backoffMin, backoffMax, timedOutAfter, breakerFailures, breakerSeconds):
+        self.backoffMin = backoffMin
+        self.backoffMax = backoffMax
+        self.timedOutAfter = timedOutAfter
+        self.breakerFailures = breakerFailures
+        self.breakerSeconds = breakerSeconds
+        self.linkUp = True
+        self.timedOut = False
+        self.failures = 0
+        self.backoff = 0
+        self.nextProbe = 0
+        self.breakers = {}
+
+    def linkFailed(self, now):
+        # Returns True when the devices have to be marked as timed out
+        self.linkUp = False
+        self.failures += 1
+        self.backoff = min(self.backoffMax, self.backoff * 2 if self.backoff else self.backoffMin)
+        self.nextProbe = now + self.backoff
+        if self.failures >= self.timedOutAfter and not self.timedOut:
+            self.timedOut = True
+            return True
+        return False
+
+    def linkOk(self):
+        # Returns True when the link was down
+        wasDown = not self.linkUp
+        self.linkUp = True
+        self.timedOut = False
+        self.failures = 0
+        self.backoff = 0
+        return wasDown
+
+    def probeDue(self, now):
+        return not self.linkUp and now >= self.nextProbe
+
+    def registerFailed(self, Unit, now):
+        # Returns True when the breaker of the register opens
+        breaker = self.breakers.setdefault(Unit, [0, 0])
+        breaker[0] += 1
+        if breaker[0] >= self.breakerFailures:
+            breaker[0] = self.breakerFailures - 1  # half-open: one more failure re-opens it
+            breaker[1] = now + self.breakerSeconds
+            return True
+        return False
+
+    def registerOk(self, Unit):
+        if Unit in self.breakers:
+            del self.breakers[Unit]
+
+    def isOpen(self, Unit, now):
+        breaker = self.breakers.get(Unit)
+        return breaker is not None and now < breaker[1]
+
+    def state(self):
+        # For the warm start snapshot, the breakers keep their wall clock end
+        return {"linkUp": self.linkUp, "failures": self.failures, "backoff": self.backoff,
+                "breakers": dict((str(Unit), breaker) for Unit, breaker in self.breakers.items())}
+
+    def restore(self, state, now):
+        # A link down at stop is probed at once
+        self.linkUp = state["linkUp"]
+        self.failures = state["failures"]
+        self.backoff = state["backoff"]
+        self.timedOut = self.failures >= self.timedOutAfter
+        self.nextProbe = now
+        self.breakers = dict((int(Unit), list(breaker)) for Unit, breaker in state["breakers"].items())
+
+
+class BusStats:
+    """
+        Counters of the bus worker and of the device updates, read and reset
+        by snapshot() for each summary.
+            Each Modbus transaction is timed under the label of its frame
+            (I0070-0078, H0001-0012, write H0006, ...) in a histogram whose
+            buckets end at the limits of BUCKETS (ms), the last one is open.
+            Errors are counted by kind, see ErrorKind.
+            A cycle is a poll job of the bus worker, an overrun a heartbeat
+            skipped because the previous poll was still running.
+        The bus worker and the plugin thread both record: under a lock.
+    """
+    BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000)
+    ERRORS = ("timeout", "crc", "illegal", "busy", "other")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.frames = {}
+        self.errors = dict((kind, 0) for kind in self.ERRORS)
+        self.cycles = 0
+        self.cycleTime = 0.0
+        self.cycleMax = 0.0
+        self.overruns = 0
+        self.updates = 0
+        self.updateTime = 0.0
+
+    def transaction(self, label, seconds, err=None):
+        with self.lock:
+            frame = self.frames.get(label)
+            if frame is None:
+                frame = self.frames[label] = [0.0, array.array("L", [0] * (len(self.BUCKETS) + 1))]
+            frame[0] += seconds
+            frame[1][bisect.bisect_left(self.BUCKETS, 1000 * seconds)] += 1
+            if err is not None:
+                self.errors[ErrorKind(err)] += 1
+
+    def cycle(self, seconds):
+        with self.lock:
+            self.cycles += 1
+            self.cycleTime += seconds
+            self.cycleMax = max(self.cycleMax, seconds)
+
+    def overrun(self):
+        with self.lock:
+            self.overruns += 1
+
+    def updated(self, seconds):
+        with self.lock:
+            self.updates += 1
+            self.updateTime += seconds
+
+    def snapshot(self):
+        # Counters since the previous snapshot
+        with self.lock:
+            stats = dict(self.__dict__)
+            del stats["lock"]
+            self.reset()
+        return stats
+
+    @classmethod
+    def percentile(cls, histogram, fraction):
+        # Upper limit (ms) of the bucket holding the fraction of the samples, None for the open one
+        rank = fraction * sum(histogram)
+        for index, count in enumerate(histogram):
+            rank -= count
+            if rank <= 0:
+                break
+        return cls.BUCKETS[index] if index < len(cls.BUCKETS) else None
+
+
+class StateWindow:
+    """
+        On/off state over the last window seconds: time on, number of starts
+        and duration of the last complete on period. The complete on periods
+        and the starts are kept only while they are in the window, so nothing
+        is scanned again when a sample comes in.
+    """
+    __slots__ = ("window", "state", "since", "first", "periods", "onTime", "starts", "lastDuration")
+
+    def __init__(self, window):
+        self.window = window
+        self.state = None
+        self.since = 0.0
+        self.first = None
+        self.periods = collections.deque()
+        self.onTime = 0.0
+        self.starts = collections.deque()
+        self.lastDuration = None
+
+    def update(self, now, on):
+        if self.first is None:
+            self.first = now
+        if on != self.state:
+            if self.state:
+                self.periods.append((self.since, now))
+                self.onTime += now - self.since
+                self.lastDuration = now - self.since
+            elif on and self.state is not None:
+                self.starts.append(now)
+            self.state = on
+            self.since = now
+        limit = now - self.window
+        while self.periods and self.periods[0][1] <= limit:
+            start, end = self.periods.popleft()
+            self.onTime -= end - start
+        while self.starts and self.starts[0] <= limit:
+            self.starts.popleft()
+
+    def duty(self, now):
+        # Part of the window (or of the time since the first sample) spent on
+        limit = now - self.window
+        onTime = self.onTime
+        if self.periods and self.periods[0][0] < limit:
+            onTime -= limit - self.periods[0][0]
+        if self.state:
+            onTime += now - max(self.since, limit)
+        span = min(self.window, now - self.first) if self.first is not None else 0
+        return onTime / span if span > 0 else 0.0
+
+
+class Metrics:
+    """
+        Values derived from the samples, updated with each one:
+            Delta_T                 leaving - return water temperature
+            Compressor_Duty         % of the last hour with the compressor on
+            Compressor_Starts       compressor starts in the last hour
+            Defrosts                defrosts in the last 24 hours
+            Defrost_Duration        last defrost, minutes
+            DHW_Reheat_Duration     last DHW reheat, minutes
+        sample() returns the device updates (unit, nValue, sValue).
+        There is no history of the samples: each metric keeps what its window
+        needs (StateWindow holds the on periods and starts still in it), so the
+        memory follows the state changes, not the read rate, and a defrost 24
+        hours ago is still counted whatever the number of PCBs polled.
+    """
+
+    def __init__(self):
+        self.last = {}
+        self.compressor = StateWindow(3600)
+        self.defrost = StateWindow(86400)
+        self.reheat = StateWindow(3600)
+
+    def sample(self, Unit, now, value):
+        self.last[Unit] = value
+        if Unit == unit.Leaving_Temp or Unit == unit.Return_Temp:
+            if unit.Leaving_Temp in self.last and unit.Return_Temp in self.last:
+                return [(unit.Delta_T, 0, "{:.1f}".format(self.last[unit.Leaving_Temp] - self.last[unit.Return_Temp]))]
+        elif Unit == unit.Compressor:
+            self.compressor.update(now, value != 0)
+            return [(unit.Compressor_Duty, 0, "{:.0f}".format(100 * self.compressor.duty(now))),
+                    (unit.Compressor_Starts, 0, str(len(self.compressor.starts)))]
+        elif Unit == unit.Defrost:
+            self.defrost.update(now, value != 0)
+            updates = [(unit.Defrosts, 0, str(len(self.defrost.starts)))]
+            if self.defrost.lastDuration is not None:
+                updates.append((unit.Defrost_Duration, 0, "{:.1f}".format(self.defrost.lastDuration / 60)))
+            return updates
+        elif Unit == unit.DHW_Reheat:
+            self.reheat.update(now, value != 0)
+            if self.reheat.lastDuration is not None:
+                return [(unit.DHW_Reheat_Duration, 0, "{:.0f}".format(self.reheat.lastDuration / 60))]
+        return []
+
+
+class ModbusTCP:
+    """
+        Modbus client for an RS485 to Ethernet gateway, with the methods of
+        minimalmodbus.Instrument used by the plugin and the same exceptions.
+            framing "tcp": Modbus TCP (MBAP header with a transaction id),
+            framing "rtu": RTU frames with CRC carried over TCP.
+        The socket is kept open between requests. After an error it is closed
+        and opened again by the next request. read_blocks sends up to pipeline
+        requests before reading their answers, when the gateway queues them.
+        With priorities (bus_broker.py) the MBAP protocol identifier of a read
+        carries its priority, given by read_blocks.
+        The frames go to recorder (a FrameRecorder) when it is set.
+    """
+
+    def __init__(self, host, port, slaveaddress, framing="tcp", timeout=1.0, pipeline=1, priorities=False):
+        self.host = host
+        self.port = port
+        self.address = slaveaddress
+        self.framing = framing
+        self.timeout = timeout
+        self.pipeline = max(1, pipeline)
+        self.priorities = priorities
+        self.connections = 0
+        self.recorder = None
+        self.__socket = None
+        self.__transaction = 0
+        self.__buffer = b""
+
+    @classmethod
+    def fromUrl(cls, url, slaveaddress, timeout=1.0):
+        # tcp://host[:502][?pipeline=n], rtutcp://host:port[?pipeline=n] or broker://host[:5020]
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.parse_qs(parts.query)
+        if not parts.hostname:
+            raise ValueError("no host in {}".format(url))
+        if parts.scheme == "broker":
+            # The broker queues the requests of all its clients and reports bus timeouts itself
+            pipeline = int(query.get("pipeline", ["10"])[0])
+            timeout = float(query.get("timeout", ["5"])[0])
+            return cls(parts.hostname, parts.port or 5020, slaveaddress, "tcp", timeout, pipeline, True)
+        framing = "rtu" if parts.scheme == "rtutcp" else "tcp"
+        pipeline = int(query.get("pipeline", ["4" if framing == "tcp" else "1"])[0])
+        return cls(parts.hostname, parts.port or 502, slaveaddress, framing, timeout, pipeline)
+
+    def close(self):
+        if self.__socket is not None:
+            try:
+                self.__socket.close()
+            except OSError:
+                pass
+            self.__socket = None
+            self.__buffer = b""
+
+    def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+        return self.read_blocks([(functioncode, registeraddress, number_of_registers)], raiseErrors=True)[0]
+
+    def read_register(self, registeraddress, number_of_decimals=0, functioncode=3, signed=False):
+        return DecodeRegister(self.read_registers(registeraddress, 1, functioncode), number_of_decimals, signed)
+
+    def write_register(self, registeraddress, value, number_of_decimals=0, functioncode=16, signed=False):
+        value = EncodeRegister(value, number_of_decimals)
+        if functioncode == 6:
+            pdu = struct.pack(">BHH", 6, registeraddress, value)
+        else:
+            pdu = struct.pack(">BHHBH", 16, registeraddress, 1, 2, value)
+        self.__exchange([(0, pdu)], True)
+
+    def write_registers(self, registeraddress, values):
+        pdu = struct.pack(">BHHB%dH" % len(values), 16, registeraddress, len(values), 2 * len(values),
+                          *[value & 0xFFFF for value in values])
+        self.__exchange([(0, pdu)], True)
+
+    def read_blocks(self, blocks, raiseErrors=False):
+        """
+            Read [(functioncode, start, count[, priority])], pipelined. Returns
+            for each block its words, or the ModbusException the slave answered.
+        """
+        answers = self.__exchange([(block[3] if self.priorities and len(block) > 3 else 0,
+                                    struct.pack(">BHH", block[0], block[1], block[2])) for block in blocks], raiseErrors)
+        return [answer if isinstance(answer, Exception) else list(struct.unpack(">%dH" % (answer[1] // 2), answer[2:]))
+                for answer in answers]
+
+    def __exchange(self, pdus, raiseErrors):
+        # Send the requests by groups of self.pipeline, return the answer PDUs in order
+        retry = self.__socket is not None
+        while True:
+            try:
+                if self.__socket is None:
+                    self.__connect()
+                answers = self.__transfer(pdus)
+                break
+            except socket.timeout:
+                # A late RTU answer would be taken for the next one, MBAP answers
+                # are taken whole and matched by transaction id
+                if self.framing == "rtu":
+                    self.close()
+                raise minimalmodbus.NoResponseError("No answer from {}:{}".format(self.host, self.port))
+            except minimalmodbus.InvalidResponseError:
+                self.close()
+                raise
+            except OSError:
+                # Gateways drop idle connections: once more on a new one
+                self.close()
+                if not retry:
+                    raise
+                retry = False
+        if raiseErrors:
+            for answer in answers:
+                if isinstance(answer, Exception):
+                    raise answer
+        return answers
+
+    def __transfer(self, pdus):
+        answers = []
+        for first in range(0, len(pdus), self.pipeline):
+            group = []
+            for protocol, pdu in pdus[first:first + self.pipeline]:
+                self.__transaction = (self.__transaction + 1) & 0xFFFF
+                group.append((self.__transaction, protocol, pdu))
+            frames = [self.__frame(transaction, protocol, pdu) for transaction, protocol, pdu in group]
+            for frame in frames:
+                self.__record(FrameRecorder.REQUEST, frame)
+            self.__socket.sendall(b"".join(frames))
+            if self.framing == "rtu":
+                received = dict((transaction, self.__receiveRTU()) for transaction, protocol, pdu in group)
+            else:
+                received = self.__receiveTCP(set(transaction for transaction, protocol, pdu in group))
+            for transaction, protocol, pdu in group:
+                answers.append(self.__answer(received[transaction], pdu[0]))
+        return answers
+
+    def __connect(self):
+        connection = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        connection.settimeout(self.timeout)
+        self.__socket = connection
+        self.__buffer = b""
+        self.connections += 1
+
+    def __frame(self, transaction, protocol, pdu):
+        if self.framing == "rtu":
+            frame = bytes([self.address]) + pdu
+            return frame + ModbusCRC(frame)
+        return struct.pack(">HHHB", transaction, protocol, len(pdu) + 1, self.address) + pdu
+
+    def __fill(self, size):
+        # At least size bytes in the buffer, nothing taken from it
+        while len(self.__buffer) < size:
+            data = self.__socket.recv(max(256, size - len(self.__buffer)))
+            if not data:
+                raise ConnectionResetError("connection closed by {}:{}".format(self.host, self.port))
+            self.__buffer += data
+
+    def __receive(self, size):
+        self.__fill(size)
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+
+    def __receiveRTU(self):
+        header = self.__receive(3)
+        if header[1] & 0x80:
+            length = 2
+        elif header[1] in (3, 4):
+            length = header[2] + 2
+        else:
+            length = 5
+        frame = header + self.__receive(length)
+        self.__record(FrameRecorder.RESPONSE, frame)
+        if ModbusCRC(frame[:-2]) != frame[-2:]:
+            raise minimalmodbus.InvalidResponseError("CRC error from {}:{}".format(self.host, self.port))
+        return frame[1:-2]
+
+    def __receiveTCP(self, transactions):
+        # Answers by transaction id, in any order (a broker sends the urgent ones first)
+        received = {}
+        while len(received) < len(transactions):
+            # A frame is only taken whole: after a timeout the stream still starts with a header
+            self.__fill(7)
+            transaction, protocol, length, slave = struct.unpack(">HHHB", self.__buffer[:7])
+            if not 2 <= length <= 254:
+                raise minimalmodbus.InvalidResponseError("MBAP length {} from {}:{}".format(length, self.host, self.port))
+            frame = self.__receive(6 + length)
+            pdu = frame[7:]
+            self.__record(FrameRecorder.RESPONSE, frame)
+            if transaction in transactions:
+                received[transaction] = pdu
+            # else: answer of a request given up after a timeout
+        return received
+
+    def __record(self, direction, frame):
+        if self.recorder is not None:
+            self.recorder.frame(direction, FrameRecorder.RTU if self.framing == "rtu" else FrameRecorder.TCP, frame)
+
+    def __answer(self, pdu, functioncode):
+        if pdu[0] == functioncode | 0x80:
+            return ModbusError(pdu[1])
+        if pdu[0] != functioncode:
+            raise minimalmodbus.InvalidResponseError("function {} answered to {}".format(pdu[0], functioncode))
+        return pdu
+
+
+class FrameRecorder:
+    """
+        Append-only log of the Modbus frames, replayed by tools/replay.py.
+        The file starts with MAGIC, then each frame as sent or received (CRC or
+        MBAP header included) follows a RECORD header: time, direction, framing
+        and length. When the file reaches maxBytes it is renamed .1 (.1 to .2,
+        ...), keep old files are kept.
+        A write error stops the recording, failed tells why.
+    """
+    MAGIC = b"RTDWFRM1"
+    RECORD = struct.Struct("<dBBH")
+    REQUEST = 0
+    RESPONSE = 1
+    RTU = 0
+    TCP = 1
+
+    def __init__(self, path, maxBytes, keep):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.keep = keep
+        self.failed = None
+        self.file = None
+        self.size = 0
+        self.__open()
+
+    def __open(self):
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write(self.MAGIC)
+            self.size = len(self.MAGIC)
+
+    def frame(self, direction, framing, data):
+        if self.file is None:
+            return
+        try:
+            self.file.write(self.RECORD.pack(time.time(), direction, framing, len(data)))
+            self.file.write(data)
+            self.size += self.RECORD.size + len(data)
+            if self.size >= self.maxBytes:
+                self.__rotate()
+        except OSError as err:
+            self.failed = str(err)
+            self.close()
+
+    def __rotate(self):
+        self.file.close()
+        for index in range(self.keep - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, index)):
+                os.replace("{}.{}".format(self.path, index), "{}.{}".format(self.path, index + 1))
+        os.replace(self.path, self.path + ".1")
+        self.__open()
+
+    def flush(self):
+        if self.file is not None:
+            try:
+                self.file.flush()
+            except OSError as err:
+                self.failed = str(err)
+                self.close()
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+
+class RecordingSerial:
+    """
+        Stand-in for the serial port of a minimalmodbus.Instrument, the frames
+        written and read are also given to a FrameRecorder.
+    """
+
+    def __init__(self, port, recorder):
+        self.port_ = port
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.port_, name)
+
+    def write(self, data):
+        self.recorder.frame(FrameRecorder.REQUEST, FrameRecorder.RTU, data)
+        return self.port_.write(data)
+
+    def read(self, size=1):
+        data = self.port_.read(size)
+        if data:
+            self.recorder.frame(FrameRecorder.RESPONSE, FrameRecorder.RTU, data)
+        return data
+
+
+class Exporter:
+    """
+        Export of the readings, one batch (time, {name: value}) per poll cycle,
+        from a thread of its own so a slow or absent server never delays the
+        bus. sender (MqttSender or InfluxSender) sends a list of batches in one
+        message.
+            The plugin thread only queues the batches, at most queueSize of
+            them: beyond that the oldest one is dropped.
+            While the server cannot be reached the batches are appended to
+            the spill file (JSON lines, up to spillBytes) and a connection is
+            tried again every retry seconds. Once connected the spilled
+            batches are sent first, chunk batches per message.
+        Messages for the Domoticz log go through post, as for the bus worker.
+    """
+
+    def __init__(self, sender, post, spillPath, queueSize, spillBytes, retry, chunk=500):
+        self.sender = sender
+        self.post = post
+        self.spillPath = spillPath
+        self.queueSize = queueSize
+        self.spillBytes = spillBytes
+        self.retry = retry
+        self.chunk = chunk
+        self.batches = collections.deque()
+        self.ready = threading.Condition()
+        self.stopping = False
+        self.connected = False
+        self.nextTry = 0
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.thread = threading.Thread(name="RTD-W export", target=self.run)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, now, values):
+        # Called by the plugin thread, never waits
+        with self.ready:
+            if len(self.batches) >= self.queueSize:
+                self.batches.popleft()
+                self.dropped += 1
+            self.batches.append((now, values))
+            self.ready.notify()
+
+    def stop(self):
+        # The batches still queued are sent or spilled
+        with self.ready:
+            self.stopping = True
+            self.ready.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.batches and not self.stopping:
+                    self.ready.wait()
+                batches = list(self.batches)
+                self.batches.clear()
+                stopping = self.stopping
+            if batches and not self.send(batches):
+                self.spill(batches)
+            if stopping:
+                break
+        self.sender.close()
+
+    def send(self, batches):
+        if not self.connected:
+            if time.time() < self.nextTry:
+                return False
+            try:
+                self.sender.connect()
+            except OSError as err:
+                self.failed(err)
+                return False
+            self.connected = True
+            self.post(("log", "Export to {} connected".format(self.sender.name)))
+            if not self.flushSpill():
+                return False
+        try:
+            self.sender.send(batches)
+        except (OSError, http.client.HTTPException) as err:
+            self.failed(err)
+            return False
+        except ValueError as err:
+            # Refused by the server: sending it again would not help
+            self.dropped += len(batches)
+            self.post(("error", "Export to {} refused {} batch(es) ({})".format(self.sender.name, len(batches), err)))
+            return True
+        self.sent += len(batches)
+        return True
+
+    def failed(self, err):
+        if self.connected or not self.nextTry:
+            self.post(("error", "Export to {} failed ({}), readings kept in {}".format(self.sender.name, err, self.spillPath)))
+        else:
+            self.post(("debug", "Export to {} still failing ({})".format(self.sender.name, err)))
+        self.connected = False
+        self.nextTry = time.time() + self.retry
+        self.sender.close()
+
+    def spill(self, batches):
+        try:
+            size = os.path.getsize(self.spillPath) if os.path.exists(self.spillPath) else 0
+            with open(self.spillPath, "a") as handle:
+                for batch in batches:
+                    line = json.dumps(batch, separators=(",", ":")) + "\n"
+                    if size + len(line) > self.spillBytes:
+                        self.dropped += 1
+                        continue
+                    handle.write(line)
+                    size += len(line)
+                    self.spilled += 1
+        except OSError as err:
+            self.dropped += len(batches)
+            self.post(("error", "Cannot spill the export to {} ({})".format(self.spillPath, err)))
+
+    def flushSpill(self):
+        # Spilled batches first, oldest first; what could not be sent is written back
+        try:
+            with open(self.spillPath) as handle:
+                lines = handle.readlines()
+        except FileNotFoundError:
+            return True
+        except OSError as err:
+            self.post(("error", "Cannot read {} ({})".format(self.spillPath, err)))
+            return True
+        batches = []
+        for line in lines:
+            try:
+                now, values = json.loads(line)
+                batches.append((now, values))
+            except ValueError:
+                self.dropped += 1
+        for first in range(0, len(batches), self.chunk):
+            try:
+                self.sender.send(batches[first:first + self.chunk])
+            except (OSError, http.client.HTTPException) as err:
+                self.failed(err)
+                try:
+                    with open(self.spillPath, "w") as handle:
+                        handle.writelines(json.dumps(batch, separators=(",", ":")) + "\n" for batch in batches[first:])
+                except OSError:
+                    pass
+                return False
+            except ValueError as err:
+                self.dropped += len(batches[first:first + self.chunk])
+                self.post(("error", "Export to {} refused {} spilled batch(es) ({})".format(self.sender.name, len(batches[first:first + self.chunk]), err)))
+        try:
+            os.remove(self.spillPath)
+        except OSError:
+            pass
+        self.sent += len(batches)
+        self.post(("log", "Export to {}: {} spilled batch(es) sent".format(self.sender.name, len(batches))))
+        return True
+
+
+class MqttSender:
+    """
+        MQTT 3.1.1 publisher for the Exporter: one QoS 1 message per send to
+        topic, a JSON object {"time": ..., "values": {...}} for one batch or an
+        array of them for several. No subscription, no keep alive (0): the
+        connection is checked by the acknowledgement of each message.
+    """
+
+    def __init__(self, host, port, topic, username=None, password=None, clientId="rtdw", timeout=5.0):
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.username = username
+        self.password = password
+        self.clientId = clientId
+        self.timeout = timeout
+        self.name = "mqtt://{}:{}/{}".format(host, port, topic)
+        self.__socket = None
+        self.__packet = 0
+
+    def connect(self):
+        connection = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        flags = 0x02
+        payload = MqttString(self.clientId)
+        if self.username:
+            flags |= 0x80
+            payload += MqttString(self.username)
+            if self.password:
+                flags |= 0x40
+                payload += MqttString(self.password)
+        try:
+            connection.sendall(MqttPacket(0x10, MqttString("MQTT") + bytes([4, flags, 0, 0]) + payload))
+            kind, body = MqttReceive(connection)
+            if kind != 0x20 or len(body) != 2 or body[1] != 0:
+                raise ConnectionRefusedError("MQTT connection refused (code {})".format(body[1] if len(body) == 2 else "?"))
+        except OSError:
+            connection.close()
+            raise
+        self.__socket = connection
+
+    def send(self, batches):
+        batches = [{"time": now, "values": values} for now, values in batches]
+        payload = json.dumps(batches[0] if len(batches) == 1 else batches, separators=(",", ":")).encode()
+        self.__packet = self.__packet % 0xFFFF + 1
+        self.__socket.sendall(MqttPacket(0x32, MqttString(self.topic) + struct.pack(">H", self.__packet) + payload))
+        while True:
+            kind, body = MqttReceive(self.__socket)
+            if kind == 0x40 and body == struct.pack(">H", self.__packet):
+                return
+
+    def close(self):
+        if self.__socket is not None:
+            try:
+                self.__socket.sendall(MqttPacket(0xE0, b""))
+                self.__socket.close()
+            except OSError:
+                pass
+            self.__socket = None
+
+
+class InfluxSender:
+    """
+        InfluxDB 1.x writer for the Exporter: one HTTP /write per send, a line
+        of protocol per batch (measurement, the values as float fields, the
+        time in seconds). A 4xx answer is a ValueError, the batches are not
+        sent again.
+    """
+
+    def __init__(self, host, port, database, measurement="rtdw", username=None, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.database = database
+        self.measurement = measurement
+        self.timeout = timeout
+        self.name = "influx://{}:{}/{}".format(host, port, database)
+        self.path = "/write?" + urllib.parse.urlencode({"db": database, "precision": "s"})
+        self.headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if username:
+            self.headers["Authorization"] = "Basic " + base64.b64encode("{}:{}".format(username, password or "").encode()).decode()
+        self.__connection = None
+
+    def connect(self):
+        self.__connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.__connection.connect()
+
+    def send(self, batches):
+        body = "".join("{} {} {}\n".format(self.measurement, ",".join("{}={!r}".format(name, float(value)) for name, value in values.items()),
+                                           int(now)) for now, values in batches if values)
+        self.__connection.request("POST", self.path, body.encode(), self.headers)
+        response = self.__connection.getresponse()
+        answer = response.read()
+        if 400 <= response.status < 500:
+            raise ValueError("HTTP {}: {}".format(response.status, answer[:200].decode(errors="replace")))
+        if response.status >= 300:
+            raise ConnectionError("HTTP {}".format(response.status))
+
+    def close(self):
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+
+class SerialTiming:
+    """
+        Response timeout of a serial port tuned to the turnaround of the slave,
+        the time between the end of the request and the start of the answer
+        (the line time, 10 bits per byte, taken out of the measured exchange).
+            Every `every` complete answers the timeout becomes the percentile
+            turnaround of the last samples times factor, plus the line time of
+            the longest answer (longest bytes), within minimum..maximum.
+            After a timeout it is widened by half for the next `every` answers
+            and the next request waits as long again, for a late answer to be
+            over before it goes on the line.
+        Tuning messages go through post, as for the bus worker.
+    """
+
+    def __init__(self, port, minimum, maximum, percentile, factor, samples, post, every=20, longest=25):
+        self.port = port
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentile = percentile
+        self.factor = factor
+        self.post = post
+        self.every = every
+        self.longest = longest
+        self.turnarounds = collections.deque(maxlen=samples)
+        self.count = 0
+        self.guard = 0.0
+        port.timeout = maximum
+
+    def lineTime(self, size):
+        return size * 10.0 / self.port.baudrate
+
+    def answered(self, elapsed, sent, received):
+        self.turnarounds.append(max(0.0, elapsed - self.lineTime(sent + received)))
+        self.count += 1
+        if self.count >= self.every:
+            self.count = 0
+            self.tune()
+
+    def tune(self):
+        ordered = sorted(self.turnarounds)
+        turnaround = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        timeout = min(self.maximum, max(self.minimum, turnaround * self.factor + self.lineTime(self.longest)))
+        if abs(timeout - self.port.timeout) > 0.1 * self.port.timeout:
+            self.post(("debug", "Serial timeout {:.0f} ms (turnaround {:.0f} ms at {:.0%} over {} answers)".format(
+                1000 * timeout, 1000 * turnaround, self.percentile, len(ordered))))
+        self.port.timeout = timeout
+
+    def timedOut(self, now):
+        self.guard = now + self.port.timeout
+        self.port.timeout = min(self.maximum, self.port.timeout * 1.5)
+        self.count = 0
+
+    def wait(self):
+        # Returns True when the request had to wait for a late answer
+        delay = self.guard - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+            return True
+        return False
+
+
+class TimedSerial:
+    """
+        Stand-in for the serial port of a minimalmodbus.Instrument measuring
+        each exchange for a SerialTiming. An answer shorter than expected is a
+        timeout unless it is a Modbus exception.
+    """
+
+    def __init__(self, port, timing):
+        self.port_ = port
+        self.timing = timing
+        self.sent = None
+
+    def __getattr__(self, name):
+        return getattr(self.port_, name)
+
+    def write(self, data):
+        if self.timing.wait():
+            self.port_.reset_input_buffer()
+        self.sent = (time.perf_counter(), len(data))
+        return self.port_.write(data)
+
+    def read(self, size=1):
+        data = self.port_.read(size)
+        if self.sent is not None:
+            start, sent = self.sent
+            self.sent = None
+            if len(data) == size:
+                self.timing.answered(time.perf_counter() - start, sent, size)
+            elif len(data) < 5 or not data[1] & 0x80:
+                self.timing.timedOut(time.perf_counter())
+        return data
+
+
 class BasePlugin:
 
     ########################################################################################
     """
         Constants
 
-        The onHeartbeat method is called every 10 seconds.
-            self.__HEARTBEATS2MIN is the number of heartbeats per minute. By using
-            self.__HEARTBEATS2MIN * self.__MINUTES you can specify the frequency in
-            minutes of updating your devices in the onHeartbeat method.
+        The onHeartbeat method is called every self.__HEARTBEAT seconds.
+            Each register is read at the period (seconds) of its tier in
+            self.__PERIODS:
+            "watch" for the status block, see self.__WATCH_REPUBLISH,
+            "fast" for the temperatures that move quickly,
+            "normal" every "Reading Interval min." (Mode3) minutes,
+            "slow" for the holding registers which only change on a command,
+            "hourly" for the running hour counter.
+            The blocks of a tier are spread over its period so every heartbeat
+            reads about the same number of frames.
     """
 
-    __HEARTBEATS2MIN = 6
-    __MINUTES = 1
+    __HEARTBEAT = 1
+    __PERIODS = {
+        "watch": 2,
+        "fast": 10,
+        "normal": 60,
+        "slow": 300,
+        "hourly": 3600,
+        }
+
+    """
+        Block reads. The registers are read with function 3/4 in as few frames
+        as possible.
+            self.__MAX_BLOCK is the number of registers the RTD-W accepts in a
+            single read (1..10, see the Modbus protocol page of the manual).
+            self.__MAX_GAP is the number of unused registers that may be read
+            inside a block to avoid an extra frame.
+    """
+    __MAX_BLOCK = 10
+    __MAX_GAP = 8
+
+    """
+        Bus worker. All Modbus transactions run in a background thread so the
+        Domoticz callbacks never wait for the serial line.
+            Jobs are taken by priority: user writes first, then routine polls.
+            Results are posted to a mailbox drained in onHeartbeat.
+            Through bus_broker.py the reads carry the priority of their tier
+            in self.__BROKER_PRIORITIES (the broker sends the writes first).
+    """
+    __PRIORITY_WRITE = 0
+    __PRIORITY_POLL = 1
+    __BROKER_PRIORITIES = {
+        "watch": 1,
+        "fast": 1,
+        "normal": 2,
+        "slow": 3,
+        "hourly": 3,
+        }
+
+    """
+        Writes. Commands are not written at once: the bus worker waits until no
+        new command came for self.__WRITE_WINDOW seconds (at most
+        self.__WRITE_MAX_DELAY seconds), keeps the last value per register,
+        writes adjacent holding registers with a single function 16 frame and
+        reads them back. Devices show the value the RTD-W accepted.
+    """
+    __WRITE_WINDOW = 1.0
+    __WRITE_MAX_DELAY = 3.0
+
+    """
+        Follow-up reads. The RTD-W shows the effect of a command on the input
+        registers a few seconds later. After a write is confirmed the devices
+        in the refresh list of the register are read again after each delay
+        (seconds) of self.__FOLLOW_UPS, whatever their period.
+    """
+    __FOLLOW_UPS = (5, 20, 60)
+
+    """
+        Watch. The "watch" tier, the status block I0070-I0078 in one frame, is
+        read every few seconds to catch the changes of state (compressor,
+        defrost, DHW) within a couple of heartbeats. Only the devices whose
+        state changed are updated, the others are published again every
+        self.__WATCH_REPUBLISH seconds.
+            When a register of the tier changes state the devices of its
+            refresh list are read after each delay (seconds) of
+            self.__TRANSITION_FOLLOW_UPS, e.g. the water temperatures at the
+            end of a defrost.
+    """
+    __WATCH_REPUBLISH = 60
+    __TRANSITION_FOLLOW_UPS = (0, 30, 120)
+
+    """
+        Device updates. The last published value of each device is kept and a
+        device is only updated when its value changes by more than the
+        deadband of its register (temperatures in °C).
+            self.__REFRESH_MINUTES forces an update even without change, so
+            devices never show as timed out in Domoticz.
+    """
+    __REFRESH_MINUTES = 15
+
+    """
+        Bus health, see BusHealth.
+            After a timeout the poll cycle is aborted and the link is probed by
+            reading self.__PROBE_REGISTER, every self.__BACKOFF_MIN seconds
+            doubling up to self.__BACKOFF_MAX seconds.
+            Devices are marked as timed out after self.__TIMEDOUT_AFTER
+            failures in a row.
+            A register refused self.__BREAKER_FAILURES times in a row is not
+            read for self.__BREAKER_MINUTES minutes.
+    """
+    __PROBE_REGISTER = (70, 4)
+    __BACKOFF_MIN = 10
+    __BACKOFF_MAX = 600
+    __TIMEDOUT_AFTER = 2
+    __BREAKER_FAILURES = 3
+    __BREAKER_MINUTES = 30
 
     """
         Constants which can be used to create the devices. Look at onStart where 
@@ -98,148 +1265,291 @@ class BasePlugin:
     """
     __UNUSED = 0
     __USED = 1
-    __NVALUE = 0 
-    __SVALUE = 1
+
+    """
+        Register maps. The tables below are for the Altherma HT hydrobox, the
+        "Equipment" parameter (Mode5) can select another map from the maps
+        folder (maps/<value>.json, same fields as DeviceDef and RegisterDef).
+    """
+    __MAP = "altherma"
+
+    """
+        Group of units. The RTD-W reports the number of PCBs on the P1P2 network
+        in self.__PCB_COUNT_REGISTER, it is read at start and when the link comes
+        back. PCB 01 is read by the registers above, each following PCB xx gets
+        the devices of self.__PCB_UNITS from unit number
+        self.__PCB_FIRST_UNIT + (xx - 2) * self.__PCB_BLOCK and the registers of
+        self.__PCB_REGISTERS at address xx00 + offset.
+            The blocks of every PCB are spread over the period of their tier
+            like the others, so each heartbeat reads the next units in turn.
+    """
+    __PCB_COUNT_REGISTER = (20, 4)
+    __PCB_MAX = 16
+    __PCB_FIRST_UNIT = 30
+    __PCB_BLOCK = 10
+
+    """
+        Statistics, see BusStats. Every self.__STATS_MINUTES minutes a summary
+        line is logged and the statistics devices are updated (created unused,
+        add them to follow the bus).
+            With "Debug" set to "Profile" the first self.__PROFILE_HEARTBEATS
+            heartbeats (5 minutes) are profiled, the plugin thread and the bus worker
+            apart. The profiles are saved as rtdw_plugin.pstats and
+            rtdw_bus.pstats in the plugin folder and their
+            self.__PROFILE_LINES most expensive functions are logged.
+    """
+    __STATS_MINUTES = 15
+    __PROFILE_HEARTBEATS = 300
+    __PROFILE_LINES = 12
+
+    """
+        Warm start. The last value read of each register, the PCB count and
+        the bus health are saved to self.__SNAPSHOT in the plugin folder
+        every self.__SNAPSHOT_MINUTES minutes and at stop. At start the values
+        younger than the period of their tier are published again and read
+        at their usual time, only the missing or stale ones are read on the
+        first heartbeat.
+    """
+    __SNAPSHOT = "rtdw_snapshot.json"
+    __SNAPSHOT_VERSION = 1
+    __SNAPSHOT_MINUTES = 10
+
+    """
+        Frame recorder, with "Debug" set to "Record frames": every frame sent
+        and received is appended to self.__RECORD_FILE in the plugin folder
+        (see FrameRecorder), rotated at self.__RECORD_MAX_MB MB with
+        self.__RECORD_KEEP old files kept.
+    """
+    __RECORD_FILE = "rtdw_frames.bin"
+    __RECORD_MAX_MB = 16
+    __RECORD_KEEP = 4
+
+    """
+        Export (Mode4), see Exporter. The values read in a poll cycle are sent
+        as one batch, named after the unit enum (Leaving_Temp, ...) or
+        Unit_<n> for the other devices.
+            At most self.__EXPORT_QUEUE batches wait in memory, then up to
+            self.__EXPORT_SPILL_MB MB in self.__EXPORT_SPILL (plugin folder)
+            while the server cannot be reached, tried again every
+            self.__EXPORT_RETRY seconds.
+    """
+    __EXPORT_QUEUE = 100
+    __EXPORT_SPILL = "rtdw_export.spill"
+    __EXPORT_SPILL_MB = 8
+    __EXPORT_RETRY = 30
+
+    """
+        Serial timing, see SerialTiming. The response timeout follows the
+        self.__TIMING_PERCENTILE turnaround of the RTD-W over its last
+        self.__TIMING_SAMPLES answers, times self.__TIMING_FACTOR, within
+        self.__TIMEOUT_MIN and self.__TIMEOUT_MAX seconds. The 3.5 character
+        silence between frames is kept by minimalmodbus.
+            With "Baud rate" set to auto the rates of self.__BAUDRATES are
+            tried fastest first when the link is probed, the first one the
+            RTD-W answers at is kept (and saved in the snapshot).
+    """
+    __TIMEOUT_MIN = 0.1
+    __TIMEOUT_MAX = 1.0
+    __TIMING_PERCENTILE = 0.99
+    __TIMING_FACTOR = 2
+    __TIMING_SAMPLES = 200
+    __BAUDRATE = 9600
+    __BAUDRATES = (38400, 19200, 9600, 4800)
 
 
     ########################################################################################
     """
-        Device definitions
-    
-            0       1       2               3       4           5           6           7      8
-            id,     name,   named type,     type,   subtype,    Switchtype, options,    used,  Description
-    Nota : la description n'est pas associée au dispositif s'il est créé en UNUSED.
+        Device definitions, see DeviceDef
     """
     __UNITS = [
-        [unit.Leaving_Temp, "Température eau départ", "Temperature", 0, 0, 0, {}, __USED, ""],
-        [unit.Return_Temp, "Température eau retour", "Temperature", 0, 0, 0, {}, __USED, ""],
-        [unit.DHW_Tank_Temp, "Température eau chaude sanitaire", "Temperature", 0, 0, 0, {}, __USED, ""],
-        [unit.Outdoor_Temp, "Température extérieure", "Temperature", 0, 0, 0, {}, __USED, ""],
-        [unit.Room_Temp, "Température intérieure", "Temperature", 0, 0, 0, {}, __USED, ""],
-        [unit.Room_Temp_Setpoint, "Consigne température de la pièce", None, 242, 1, 0, {}, __USED, "Réglable entre 16 et 32°C"],
-        [unit.Leaving_Water_Setpoint, "Consigne température eau chauffage", None, 242, 1, 0, {}, __USED, "Réglable entre 25 et 80°C"],
-        [unit.ON_OFF_Command_Space_Heating, "Commande M/A chauffage", "Switch", 0, 0, 0, {}, __UNUSED, ""],
-        [unit.DHW_Reheat_Command, "Commande réchauffage ECS", "Switch", 0, 0, 0, {}, __UNUSED, ""],
-        [unit.Start_DHW_Storage, "Commande stockage ECS", "Switch", 0, 0, 0, {}, __UNUSED, ""],
-        [unit.Control_Source, "Sources de contrôle", "Selector Switch", 0, 0, 0,
-            {"LevelNames" : "Tout|Externe|Local|Tout",
-             "LevelOffHidden" : "true",
-             "SelectorStyle" : "0"},
-             __UNUSED, ""],
-        [unit.Quiet_Mode, "Mode silencieux", "Switch", 0, 0, 0, {}, __UNUSED, ""],
-        [unit.Weather_Dependent_Setpoint_Operation, "Temp départ / Temp ext.", "Switch", 0, 0, 0, {}, __UNUSED, ""],
-        [unit.Shift_Value_Leaving_Water_Temp, "Décalage temp. départ", "Selector Switch", 0, 0, 0,
-             {"LevelNames" : "|-5°C|-4°C|-3°C|-2°C|-1°C|0°C|+1°C|+2°C|+3°C|+4°C|+5°C",
-              "LevelOffHidden" : "true",
-              "SelectorStyle" : "1"},
-             __USED, "Réglable entre -5 et +5°C"],
-        [unit.Reset_Run_Hour_Counter, "Reset compteur", "Push On", 0, 0, 0, {}, __UNUSED,""],
-        [unit.ON_OFF_Space_Heating, "Etat chauffage", "Contact", 0, 0, 0, {}, __USED, ""],
-        [unit.Circulation_Pump, "Etat pompe", "Contact", 0, 0, 0, {}, __USED, ""],
-        [unit.Compressor, "Etat compresseur", "Contact", 0, 0, 0, {}, __USED, ""],
-        [unit.Disinfection, "Etat désinfection ECS", "Contact", 0, 0, 0, {}, __USED, ""],        
-        [unit.Setback, "Mode réduit", "Contact", 0, 0, 0, {}, __USED, ""],  
-        [unit.Defrost, "Dégivrage", "Contact", 0, 0, 0, {}, __USED, ""],  
-        [unit.DHW_Reheat, "Etat réchauffage ECS", "Contact", 0, 0, 0, {}, __USED, ""],  
-        [unit.DHW_Storage, "Etat Stockage ECS", "Contact", 0, 0, 0, {}, __USED, ""],  
-        [unit.Pump_Running_Hour_Counter, "Compteur horaire pompe", None, 113, 0, 3,{"ValueQuantity":"Temps","ValueUnits":"heures"}, __USED, ""]
+        DeviceDef(unit.Leaving_Temp, "Température eau départ", "Temperature"),
+        DeviceDef(unit.Return_Temp, "Température eau retour", "Temperature"),
+        DeviceDef(unit.DHW_Tank_Temp, "Température eau chaude sanitaire", "Temperature"),
+        DeviceDef(unit.Outdoor_Temp, "Température extérieure", "Temperature"),
+        DeviceDef(unit.Room_Temp, "Température intérieure", "Temperature"),
+        DeviceDef(unit.Room_Temp_Setpoint, "Consigne température de la pièce", None, 242, 1, description="Réglable entre 16 et 32°C"),
+        DeviceDef(unit.Leaving_Water_Setpoint, "Consigne température eau chauffage", None, 242, 1, description="Réglable entre 25 et 80°C"),
+        DeviceDef(unit.ON_OFF_Command_Space_Heating, "Commande M/A chauffage", "Switch", used=__UNUSED),
+        DeviceDef(unit.DHW_Reheat_Command, "Commande réchauffage ECS", "Switch", used=__UNUSED),
+        DeviceDef(unit.Start_DHW_Storage, "Commande stockage ECS", "Switch", used=__UNUSED),
+        DeviceDef(unit.Control_Source, "Sources de contrôle", "Selector Switch",
+            options={"LevelNames" : "Tout|Externe|Local|Tout",
+                     "LevelOffHidden" : "true",
+                     "SelectorStyle" : "0"},
+            used=__UNUSED),
+        DeviceDef(unit.Quiet_Mode, "Mode silencieux", "Switch", used=__UNUSED),
+        DeviceDef(unit.Weather_Dependent_Setpoint_Operation, "Temp départ / Temp ext.", "Switch", used=__UNUSED),
+        DeviceDef(unit.Shift_Value_Leaving_Water_Temp, "Décalage temp. départ", "Selector Switch",
+            options={"LevelNames" : "|-5°C|-4°C|-3°C|-2°C|-1°C|0°C|+1°C|+2°C|+3°C|+4°C|+5°C",
+                     "LevelOffHidden" : "true",
+                     "SelectorStyle" : "1"},
+            description="Réglable entre -5 et +5°C"),
+        DeviceDef(unit.Reset_Run_Hour_Counter, "Reset compteur", "Push On", used=__UNUSED),
+        DeviceDef(unit.ON_OFF_Space_Heating, "Etat chauffage", "Contact"),
+        DeviceDef(unit.Circulation_Pump, "Etat pompe", "Contact"),
+        DeviceDef(unit.Compressor, "Etat compresseur", "Contact"),
+        DeviceDef(unit.Disinfection, "Etat désinfection ECS", "Contact"),
+        DeviceDef(unit.Setback, "Mode réduit", "Contact"),
+        DeviceDef(unit.Defrost, "Dégivrage", "Contact"),
+        DeviceDef(unit.DHW_Reheat, "Etat réchauffage ECS", "Contact"),
+        DeviceDef(unit.DHW_Storage, "Etat Stockage ECS", "Contact"),
+        DeviceDef(unit.Pump_Running_Hour_Counter, "Compteur horaire pompe", None, 113, 0, 3, {"ValueQuantity":"Temps","ValueUnits":"heures"}),
         ]
-        
-##"""
-##        Device registers
-##            0   1        2              3           4       5
-##            id, address, nd_décimals,   function,   Signed, Type
-##"""
+
+    """
+        Device registers, see RegisterDef
+            The status block I0070-I0078 is read as a whole in the watch tier,
+            it is one frame anyway.
+            The command switches are updated from the status registers.
+            The temperatures outside their plausible range, or moving faster
+            than their rate (°C per minute), are dropped, see BlockDecoder.
+    """
     __REGISTERS = [
-        [unit.Leaving_Temp, 123, 2, 4, True, __SVALUE],
-        [unit.Return_Temp, 131, 2, 4, True, __SVALUE],
-        [unit.DHW_Tank_Temp, 132, 2, 4, True, __SVALUE],
-        [unit.Outdoor_Temp, 133, 2, 4, True, __SVALUE],
-        [unit.Room_Temp, 50, 2, 4, True, __SVALUE],
-        [unit.Room_Temp_Setpoint, 5, 0, 3, False, __SVALUE],
-        [unit.Leaving_Water_Setpoint, 1, 0,  3, False, __SVALUE],
-        [unit.ON_OFF_Command_Space_Heating, 4, 0, 3, False, __NVALUE],
-        [unit.DHW_Reheat_Command, 6, 0, 3, False, __NVALUE],
-        [unit.Start_DHW_Storage, 7, 0, 3, False, __NVALUE],
-        [unit.Control_Source, 8, 0, 3, False, __SVALUE],
-        [unit.Quiet_Mode, 9, 0, 3, False, __NVALUE],
-        [unit.Weather_Dependent_Setpoint_Operation, 10, 0, 3, False, __NVALUE],
-        [unit.Shift_Value_Leaving_Water_Temp, 11, 0, 3, True, __SVALUE],
-        [unit.Reset_Run_Hour_Counter, 12, 0,  3, False, __SVALUE],    
-        [unit.ON_OFF_Space_Heating, 70, 0, 4, False, __NVALUE],
-        [unit.Circulation_Pump, 71, 0, 4, False, __NVALUE],
-        [unit.Compressor, 72, 0, 4, False, __NVALUE],
-        [unit.Disinfection, 74, 0, 4, False, __NVALUE],      
-        [unit.Setback, 75, 0, 4, False, __NVALUE],
-        [unit.Defrost, 76, 0, 4, False, __NVALUE],         
-        [unit.DHW_Reheat, 77, 0, 4, False, __NVALUE],
-        [unit.DHW_Storage, 78, 0, 4, False, __NVALUE],
-        [unit.Pump_Running_Hour_Counter, 80, 0, 4, False, __SVALUE]
-         ]
-    
+        RegisterDef(unit.Leaving_Temp, 123, 4, 2, True, period="fast", deadband=0.1, plausible=(-10, 95), rate=10),
+        RegisterDef(unit.Return_Temp, 131, 4, 2, True, deadband=0.1, plausible=(-10, 95), rate=10),
+        RegisterDef(unit.DHW_Tank_Temp, 132, 4, 2, True, deadband=0.1, plausible=(0, 95), rate=5),
+        RegisterDef(unit.Outdoor_Temp, 133, 4, 2, True, deadband=0.1, plausible=(-40, 50), rate=3),
+        RegisterDef(unit.Room_Temp, 50, 4, 2, True, deadband=0.1, plausible=(-10, 50), rate=3),
+        RegisterDef(unit.Room_Temp_Setpoint, 5, 3, period="slow", encoder="level", minimum=16, maximum=32),
+        RegisterDef(unit.Leaving_Water_Setpoint, 1, 3, period="slow", encoder="level", minimum=25, maximum=80,
+                    refresh=[unit.Circulation_Pump, unit.Compressor]),
+        RegisterDef(unit.ON_OFF_Command_Space_Heating, 4, 3, period="slow", decoder="switch", encoder="level", targets=[],
+                    refresh=[unit.ON_OFF_Space_Heating, unit.Circulation_Pump, unit.Compressor]),
+        RegisterDef(unit.DHW_Reheat_Command, 6, 3, period="slow", decoder="switch", encoder="level", targets=[],
+                    refresh=[unit.DHW_Reheat]),
+        RegisterDef(unit.Start_DHW_Storage, 7, 3, period="slow", decoder="switch", encoder="level",
+                    refresh=[unit.DHW_Storage]),
+        RegisterDef(unit.Control_Source, 8, 3, period="slow", decoder="source", encoder="source", minimum=0, maximum=3),
+        RegisterDef(unit.Quiet_Mode, 9, 3, period="slow", decoder="switch", encoder="level"),
+        RegisterDef(unit.Weather_Dependent_Setpoint_Operation, 10, 3, period="slow", decoder="switch", encoder="level",
+                    refresh=[unit.Leaving_Water_Setpoint]),
+        RegisterDef(unit.Shift_Value_Leaving_Water_Temp, 11, 3, 0, True, period="slow", decoder="shift", encoder="shift",
+                    minimum=-5, maximum=5, refresh=[unit.Leaving_Water_Setpoint]),
+        RegisterDef(unit.Reset_Run_Hour_Counter, 12, 3, period="slow", decoder="pulse", encoder="reset",
+                    refresh=[unit.Pump_Running_Hour_Counter]),
+        RegisterDef(unit.ON_OFF_Space_Heating, 70, period="watch", decoder="switch",
+                    targets=[unit.ON_OFF_Space_Heating, unit.ON_OFF_Command_Space_Heating]),
+        RegisterDef(unit.Circulation_Pump, 71, period="watch", decoder="switch"),
+        RegisterDef(unit.Compressor, 72, period="watch", decoder="switch",
+                    refresh=[unit.Leaving_Temp, unit.Return_Temp]),
+        RegisterDef(unit.Disinfection, 74, period="watch", decoder="switch",
+                    refresh=[unit.DHW_Tank_Temp]),
+        RegisterDef(unit.Setback, 75, period="watch", decoder="switch"),
+        RegisterDef(unit.Defrost, 76, period="watch", decoder="switch",
+                    refresh=[unit.Leaving_Temp, unit.Return_Temp]),
+        RegisterDef(unit.DHW_Reheat, 77, period="watch", decoder="switch",
+                    targets=[unit.DHW_Reheat, unit.DHW_Reheat_Command], refresh=[unit.DHW_Tank_Temp]),
+        RegisterDef(unit.DHW_Storage, 78, period="watch", decoder="switch"),
+        RegisterDef(unit.Pump_Running_Hour_Counter, 80, words=2, period="hourly", decoder="counter"),
+        ]
+
+    """
+        Devices and registers of PCB 02..16, unit is the index in the block of
+        the PCB and address the offset in Ixx00..Ixx99
+    """
+    __PCB_UNITS = [
+        DeviceDef(0, "Température eau départ", "Temperature"),
+        DeviceDef(1, "Température eau retour", "Temperature"),
+        DeviceDef(2, "Température eau chaude sanitaire", "Temperature"),
+        DeviceDef(3, "Température extérieure", "Temperature"),
+        ]
+
+    __PCB_REGISTERS = [
+        RegisterDef(0, 23, 4, 2, True, deadband=0.1, plausible=(-10, 95), rate=10),
+        RegisterDef(1, 31, 4, 2, True, deadband=0.1, plausible=(-10, 95), rate=10),
+        RegisterDef(2, 32, 4, 2, True, deadband=0.1, plausible=(0, 95), rate=5),
+        RegisterDef(3, 33, 4, 2, True, deadband=0.1, plausible=(-40, 50), rate=3),
+        ]
+
+    """
+        Derived values (see Metrics), computed from the values read. A device
+        is created when the registers it comes from are in the map. The last column is the
+        deadband of the device, as for the registers.
+    """
+    __METRIC_UNITS = [
+        (DeviceDef(unit.Delta_T, "Delta T départ / retour", "Temperature"), (unit.Leaving_Temp, unit.Return_Temp), 0.2),
+        (DeviceDef(unit.Compressor_Duty, "Taux de marche compresseur", "Percentage"), (unit.Compressor,), 2),
+        (DeviceDef(unit.Compressor_Starts, "Démarrages compresseur", "Custom", options={"Custom": "1;/h"}), (unit.Compressor,), 0),
+        (DeviceDef(unit.Defrosts, "Dégivrages", "Custom", options={"Custom": "1;/24h"}), (unit.Defrost,), 0),
+        (DeviceDef(unit.Defrost_Duration, "Durée dernier dégivrage", "Custom", options={"Custom": "1;min"}), (unit.Defrost,), 0),
+        (DeviceDef(unit.DHW_Reheat_Duration, "Durée dernier réchauffage ECS", "Custom", options={"Custom": "1;min"}), (unit.DHW_Reheat,), 0),
+        ]
+
+    """
+        Bus statistics devices, counts are per self.__STATS_MINUTES minutes
+    """
+    __STATS_UNITS = [
+        DeviceDef(unit.Bus_Cycle, "Durée cycle Modbus", "Custom", options={"Custom": "1;ms"}, used=__UNUSED),
+        DeviceDef(unit.Bus_Load, "Occupation bus Modbus", "Percentage", used=__UNUSED),
+        DeviceDef(unit.Bus_Timeouts, "Timeouts Modbus", "Custom", options={"Custom": "1;/{} min".format(__STATS_MINUTES)}, used=__UNUSED),
+        DeviceDef(unit.Bus_CRC_Errors, "Erreurs CRC Modbus", "Custom", options={"Custom": "1;/{} min".format(__STATS_MINUTES)}, used=__UNUSED),
+        DeviceDef(unit.Bus_Illegal_Requests, "Requêtes refusées Modbus", "Custom", options={"Custom": "1;/{} min".format(__STATS_MINUTES)}, used=__UNUSED),
+        DeviceDef(unit.Heartbeat_Overruns, "Dépassements heartbeat", "Custom", options={"Custom": "1;/{} min".format(__STATS_MINUTES)}, used=__UNUSED),
+        ]
+
     ########################################################################################
 
     def __init__(self):
-        self.__runAgain = 0
+        self.__units = self.__UNITS
+        self.__registers = self.__REGISTERS
+        self.__pcbUnits = self.__PCB_UNITS
+        self.__pcbRegisters = self.__PCB_REGISTERS
+        self.__mapRegisters = self.__REGISTERS
+        self.__pcbs = 1
+        self.__names = {}
+        self.__writable = {}
+        self.__deadbands = {}
+        self.__periods = dict(self.__PERIODS)
+        self.__phases = {}
+        self.__due = {}
+        self.__plans = {}
+        self.__gaps = set()
+        self.__present = None
+        self.__polled = []
+        self.__followUps = []
+        self.__jobs = queue.PriorityQueue()
+        self.__results = queue.Queue()
+        self.__sequence = itertools.count()
+        self.__stopping = threading.Event()
+        self.__pollPending = False
+        self.__worker = None
+        self.__shadow = {}
+        self.__values = {}
+        self.__watched = {}
+        self.__suspects = {}
+        self.__dropped = 0
+        self.__savedAt = 0
+        self.__metrics = Metrics()
+        self.__stats = BusStats()
+        self.__statsSince = 0
+        self.__profile = None
+        self.__profileBeats = 0
+        self.__recorder = None
+        self.__exporter = None
+        self.__batch = {}
+        self.__baudrate = self.__BAUDRATE
+        self.__baudAuto = False
+        self.__baudFound = False
+        self.__port = None
+        self.__timing = None
+        self.__health = BusHealth(self.__BACKOFF_MIN, self.__BACKOFF_MAX, self.__TIMEDOUT_AFTER,
+                                  self.__BREAKER_FAILURES, self.__BREAKER_MINUTES * 60)
 
 
     def onCommand(self, Unit, Command, Level, Hue):
         Domoticz.Debug("onCommand: {}, {}, {}, {}".format(Unit, Command, Level, Hue))
 
-        # ON/OFF or Level payload value
-        payload = int(Level) # Set payload from slider/scroll or setpoint device
-        # Set payload if a button has been pressed
-        if (str(Command) == "On"): payload = 1
-        if (str(Command) == "Off"): payload = 0
-        # Check limit temperature setpoint
-        if (Unit == unit.Room_Temp_Setpoint):
-            if(Level < 16):
-                payload = int(16 )
-            elif(Level > 32):
-                payload = int(32 )
-        if (Unit == unit.Leaving_Water_Setpoint):
-            if(Level < 25):
-                payload = int(25)
-            elif(Level > 80):
-                payload = int(80)
-        if (Unit == unit.Shift_Value_Leaving_Water_Temp):
-            payload = int((Level / 10)-6)
-            if(payload < -5):
-                payload = int(-5)
-            elif(payload > 5):
-                payload = int(5)
-        if (Unit == unit.Control_Source):
-            payload = int((Level / 10))
-            if(payload < 0 or payload > 3):
-                payload = int(0)
-
+        register = self.__writable.get(Unit)
+        if register is None:
+            Domoticz.Debug("Device {} has no register to write".format(Unit))
+            return
 
         ########################################
         # WRITE PAYLOAD 
         ########################################
-        register_info = self.__REGISTERS[Unit-1]
-        if register_info[3] ==  3:
-            try:
-                # Function to execute
-                result = self.rs485.write_register(register_info[1], payload, number_of_decimals=register_info[2], functioncode=6, signed=register_info[4])
-
-                Domoticz.Log("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
-                Domoticz.Log("write_register n° " + str(register_info[1]) + "', Payload= " + str(payload) +  ", nb_decimals = " + str(register_info[2]) +", signed: " + str(register_info[4]))
-
-                Domoticz.Debug("MODBUS DEBUG - RESULT: " + str(result))
-                if (str(Command) == "On"): Devices[Unit].Update(1, "1")  # Update device to ON
-                if (str(Command) == "Off"): Devices[Unit].Update(0, "0") # Update device to OFF
-                if (str(Command) == "Set Level"):
-                    if (Unit == unit.Shift_Value_Leaving_Water_Temp):
-                        Devices[Unit].Update(int(payload!=0), str((payload+6) * 10))   # Update Level device convert for switch selector
-                    elif (Unit == unit.Control_Source):
-                        Devices[Unit].Update(int(payload!=2), str(payload * 10))       # Update Level device convert for switch selector
-                    else:
-                        Devices[Unit].Update(0, str(payload)) # Update Level device
-                   
-            except:
-                Domoticz.Error("Modbus error communicating! check your settings!")
-                       
+        payload = register.encode(register, Command, Level)
+        Domoticz.Log("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
+        self.__submit(self.__PRIORITY_WRITE, "write", (register, Command, payload))
 
     def onConnect(self, Connection, Status, Description):
         Domoticz.Debug(
@@ -251,41 +1561,670 @@ class BasePlugin:
 
     def onHeartbeat(self):
         Domoticz.Debug("onHeartbeat")
-        self.__runAgain -= 1
-        if self.__runAgain <= 0:
-            self.__runAgain = self.__HEARTBEATS2MIN * self.__MINUTES
-                               
-            # Get data from RTD-W and Update devices
-            for Unit in self.__REGISTERS:
-                if Unit[0] in Devices:
-                    if Unit[0] == unit.Pump_Running_Hour_Counter:
-                        value = self.rs485.read_long(Unit[1], functioncode=Unit[3], signed=Unit[4])
-                    else:
-                        value = self.rs485.read_register(Unit[1], number_of_decimals=Unit[2], functioncode=Unit[3], signed=Unit[4])
-##                  if Unit[5] == int(__NVALUE):
-                    if Unit[5] == 0:
-                        if Unit[0] == unit.ON_OFF_Command_Space_Heating or Unit[0] == unit.DHW_Reheat_Command:
-                            pass
-                        elif Unit[0] == unit.ON_OFF_Space_Heating:
-                            Devices[Unit[0]].Update( int(value), str(value * 100))
-                            Devices[unit.ON_OFF_Command_Space_Heating].Update( int(value), str(value * 100))
-                        elif Unit[0] == unit.DHW_Reheat:
-                            Devices[Unit[0]].Update( int(value), str(value * 100))
-                            Devices[unit.DHW_Reheat_Command].Update( int(value), str(value * 100))
-                        else:
-                            Devices[Unit[0]].Update( int(value), str(value * 100))
-                    elif Unit[0] == unit.Shift_Value_Leaving_Water_Temp:
-                        Devices[Unit[0]].Update( int(value!=0), str((value+6) * 10))
-                    elif (Unit[0] == unit.Control_Source):
-                        Devices[Unit[0]].Update(int(value!=2), str(value * 10))
-                    elif Unit[0] == unit.Pump_Running_Hour_Counter:
-                        Devices[Unit[0]].Update( 0, str(value)+";0")
+        if self.__profile is not None:
+            self.__profileBeats -= 1
+            if self.__profileBeats <= 0:
+                self.__profiled()
+        self.__drainResults()
+        now = time.time()
+        if now - self.__statsSince >= self.__STATS_MINUTES * 60:
+            self.__summary(now - self.__statsSince)
+            self.__statsSince = now
+        if now - self.__savedAt >= self.__SNAPSHOT_MINUTES * 60:
+            self.__save(now)
+        if self.__pollPending:
+            Domoticz.Debug( "onHeartbeat - previous poll still running" )
+            self.__stats.overrun()
+            return
+
+        # Link down: only a cheap probe, when the backoff has elapsed
+        if not self.__health.linkUp:
+            if self.__health.probeDue(now):
+                self.__pollPending = True
+                self.__submit(self.__PRIORITY_POLL, "probe", self.__PROBE_REGISTER)
+            return
+
+        present = tuple(Unit for Unit in self.__names if Unit in Devices)
+        if present != self.__present:
+            for Unit in self.__names:
+                if Unit not in Devices:
+                    Domoticz.Debug( "Device {} - {} does not exist".format(Unit, self.__names[Unit]) )
+            self.__polled = [register for register in self.__registers
+                             if any(target in Devices for target in register.targets)]
+            self.__present = present
+
+        # Registers due for reading, read together in one poll
+        horizon = now + self.__HEARTBEAT / 2
+        while self.__followUps and self.__followUps[0][0] <= horizon:
+            self.__due[heapq.heappop(self.__followUps)[1]] = 0
+        due = [register for register in self.__polled if self.__due.get(register.unit, 0) <= horizon
+               and not self.__health.isOpen(register.unit, now)]
+        if not due:
+            return
+        key = tuple(register.unit for register in due)
+        plan = self.__plans.get(key)
+        if plan is None:
+            plan = [block + (BlockDecoder(*block[1:]),) for block in PlanReads(due, self.__MAX_GAP, self.__MAX_BLOCK, self.__gaps)]
+            self.__plans[key] = plan
+            Domoticz.Debug( "Read plan: {} registers in {} frames".format(len(due), len(plan)) )
+        for register in due:
+            if register.unit in self.__due:
+                self.__due[register.unit] = now + self.__periods[register.period]
+            else:
+                self.__due[register.unit] = now + self.__phases[register.unit]
+
+        # Get data from RTD-W, devices are updated when the results come back
+        self.__pollPending = True
+        self.__submit(self.__PRIORITY_POLL, "poll", plan)
+
+    def __drainResults(self):
+        # Apply the results posted by the bus worker
+        while True:
+            try:
+                kind, data = self.__results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "values":
+                now = time.time()
+                for register, value in data:
+                    self.__health.registerOk(register.unit)
+                    last = self.__values.get(register.unit)
+                    if register.rate and last is not None and self.__spike(register, last, value, now):
+                        continue
+                    self.__values[register.unit] = (now, value)
+                    # Exported with the cycle even when the device is not updated
+                    self.__batch[ExportName(register.unit)] = value
+                    if register.period == "watch":
+                        if last is not None and last[1] != value:
+                            self.__transition(register, last[1], value, now)
+                        elif now - self.__watched.get(register.unit, 0) < self.__WATCH_REPUBLISH:
+                            continue
+                        self.__watched[register.unit] = now
+                    self.__publish(register, value, now)
+            elif kind == "polled":
+                self.__pollPending = False
+                if self.__batch:
+                    if self.__exporter is not None:
+                        self.__exporter.put(int(time.time()), self.__batch)
+                    self.__batch = {}
+            elif kind == "invalid":
+                for register, value, problem in data:
+                    self.__health.registerOk(register.unit)
+                    self.__drop(register, value, problem)
+            elif kind == "link":
+                self.__link(*data)
+            elif kind == "pcbs":
+                self.__discovered(data)
+            elif kind == "baudrate":
+                self.__baudrate = data
+                Domoticz.Status("RTD-W answers at {} bauds".format(data))
+            elif kind == "refused":
+                self.__refused(*data)
+            elif kind == "gaps":
+                self.__refusedGaps(*data)
+            elif kind == "written":
+                self.__written(*data)
+            elif kind == "debug":
+                Domoticz.Debug(data)
+            elif kind == "log":
+                Domoticz.Log(data)
+            elif kind == "error":
+                Domoticz.Error(data)
+
+    def __spike(self, register, last, value, now):
+        # A jump faster than the rate of the register, unless the value before confirms it
+        if abs(value - last[1]) <= register.rate * max(1.0, (now - last[0]) / 60):
+            self.__suspects.pop(register.unit, None)
+            return False
+        suspect = self.__suspects.pop(register.unit, None)
+        if suspect is not None and abs(value - suspect) <= register.rate:
+            return False
+        self.__suspects[register.unit] = value
+        self.__drop(register, value, "{} -> {} too fast".format(last[1], value))
+        return True
+
+    def __drop(self, register, value, problem):
+        self.__dropped += 1
+        Domoticz.Debug("Value {} of device {} dropped ({})".format(value, register.unit, problem))
+
+    def __link(self, ok, message):
+        if ok:
+            if self.__health.linkOk():
+                Domoticz.Status("RTD-W link restored")
+                # Read everything again, this also clears the timed out flags
+                self.__due.clear()
+                self.__watched.clear()
+                self.__submit(self.__PRIORITY_POLL, "discover", self.__PCB_COUNT_REGISTER)
+        else:
+            if self.__health.linkFailed(time.time()):
+                for Unit in list(self.__shadow):
+                    if Unit in Devices:
+                        self.__update(Unit, Devices[Unit].nValue, Devices[Unit].sValue, TimedOut=1)
+            if self.__health.failures == 1:
+                Domoticz.Error("RTD-W not responding ({}), probing every {} s".format(message, self.__health.backoff))
+            else:
+                Domoticz.Debug("RTD-W still not responding ({}), next probe in {} s".format(message, self.__health.backoff))
+
+    def __discovered(self, count):
+        # PCB count of the group: 32767 when not available, then a single unit
+        if count < 1 or count > self.__PCB_MAX:
+            count = 1
+        if count == self.__pcbs:
+            return
+        Domoticz.Status("RTD-W group of {} unit(s)".format(count))
+        registers = list(self.__mapRegisters)
+        units = []
+        try:
+            for pcb in range(2, count + 1):
+                pcbUnits, pcbRegisters = ExpandPCB(self.__pcbUnits, self.__pcbRegisters, pcb,
+                                                   self.__PCB_FIRST_UNIT + (pcb - 2) * self.__PCB_BLOCK, self.__PCB_BLOCK)
+                units.extend(pcbUnits)
+                registers.extend(pcbRegisters)
+            CompileMap(self.__units + units, registers, self.__periods)
+        except ValueError as err:
+            Domoticz.Error("Cannot poll the units of the group ({})".format(err))
+            return
+        self.__createDevices(units)
+        self.__names.update((Unit.unit, Unit.name) for Unit in units)
+        self.__setRegisters(registers)
+        self.__pcbs = count
+
+    def __setRegisters(self, registers):
+        # Registers to poll, with the start of each one in its tier
+        self.__registers = registers
+        self.__deadbands = dict((target, register.deadband) for register in registers
+                                for target in register.targets if register.deadband)
+        self.__deadbands.update((Unit.unit, deadband) for Unit, sources, deadband in self.__METRIC_UNITS if deadband)
+        self.__phases = {}
+        for tier, period in self.__periods.items():
+            blocks = PlanReads([register for register in registers if register.period == tier], self.__MAX_GAP, self.__MAX_BLOCK,
+                               self.__gaps)
+            for index, block in enumerate(blocks):
+                for register, offset in block[3]:
+                    self.__phases[register.unit] = period * (index + 1) / len(blocks)
+        self.__plans = {}
+        self.__present = None
+
+    def __refused(self, units, message):
+        now = time.time()
+        for Unit in units:
+            if self.__health.registerFailed(Unit, now):
+                Domoticz.Error("Register of device {} refused ({}), not read for {} min.".format(Unit, message, self.__BREAKER_MINUTES))
+
+    def __refusedGaps(self, functioncode, start, count, gaps):
+        # A block refused for its unused registers only: plan the reads around them
+        new = set((functioncode, address) for address in gaps) - self.__gaps
+        if not new:
+            return
+        self.__gaps.update(new)
+        self.__plans = {}
+        Domoticz.Log("RTD-W refused the read of {} for its unused register(s) {}, read plan split around them".format(
+            FrameLabel(functioncode, start, count), ", ".join(FrameLabel(functioncode, address, 1) for address in sorted(gaps))))
+
+    def __written(self, register, Command, payload, value):
+        Domoticz.Log("Written n° " + str(register.address) + ", Payload= " + str(payload) +  ", read back: " + str(value))
+        if value != payload and register.encoder != "reset":
+            Domoticz.Status("RTD-W register {} holds {} instead of {}".format(register.address, value, payload))
+        nValue, sValue = register.decode(value)
+        self.__update(register.unit, nValue, sValue)
+
+        # Read the registers showing the effect of the command
+        now = time.time()
+        self.__values[register.unit] = (now, value)
+        self.__batch[ExportName(register.unit)] = value
+        self.__followUp(register.refresh, now, self.__FOLLOW_UPS)
+
+    def __transition(self, register, before, value, now):
+        # A change of state: read the devices it affects without waiting for their tier
+        if register.refresh:
+            Domoticz.Debug("{} {} -> {}, reading devices {} again".format(
+                self.__names.get(register.unit, register.unit), before, value, list(register.refresh)))
+            self.__followUp(register.refresh, now, self.__TRANSITION_FOLLOW_UPS)
+
+    def __followUp(self, units, now, delays):
+        for dependent in units:
+            for delay in delays:
+                heapq.heappush(self.__followUps, (now + delay, dependent))
+
+    def __submit(self, priority, kind, data):
+        self.__jobs.put((priority, next(self.__sequence), kind, data))
+
+    def __summary(self, seconds):
+        # One log line and the statistics devices for the last period
+        stats = self.__stats.snapshot()
+        frames = stats["frames"]
+        busy = sum(frame[0] for frame in frames.values())
+        cycle = 1000 * stats["cycleTime"] / stats["cycles"] if stats["cycles"] else 0.0
+        slowest = []
+        for label, (spent, histogram) in sorted(frames.items(), key=lambda item: -item[1][0])[:3]:
+            p95 = BusStats.percentile(histogram, 0.95)
+            slowest.append("{} {:.0f}% p95 {}".format(label, 100 * spent / busy if busy else 0,
+                                                      "{} ms".format(p95) if p95 else "> {} ms".format(BusStats.BUCKETS[-1])))
+        Domoticz.Log("RTD-W bus, last {:.0f} min: {} frames, {}; cycle {:.0f} ms (max {:.0f}), {} overrun(s); "
+                     "{} updates ({:.2f} ms each), {} value(s) dropped; bus time: {}".format(
+                         seconds / 60, sum(sum(frame[1]) for frame in frames.values()),
+                         ", ".join("{} {}".format(count, kind) for kind, count in stats["errors"].items() if count) or "no error",
+                         cycle, 1000 * stats["cycleMax"], stats["overruns"],
+                         stats["updates"], 1000 * stats["updateTime"] / stats["updates"] if stats["updates"] else 0.0,
+                         self.__dropped, ", ".join(slowest) or "-"))
+        self.__dropped = 0
+        values = {
+            unit.Bus_Cycle: "{:.0f}".format(cycle),
+            unit.Bus_Load: "{:.1f}".format(100 * busy / seconds),
+            unit.Bus_Timeouts: str(stats["errors"]["timeout"]),
+            unit.Bus_CRC_Errors: str(stats["errors"]["crc"]),
+            unit.Bus_Illegal_Requests: str(stats["errors"]["illegal"]),
+            unit.Heartbeat_Overruns: str(stats["overruns"]),
+            }
+        for Unit, sValue in values.items():
+            if Unit in Devices and Devices[Unit].Used:
+                self.__update(Unit, 0, sValue)
+
+    def __profiled(self):
+        # End of the capture: the bus worker saves its own profile
+        self.__profile.disable()
+        try:
+            for line in ProfileReport(self.__profile, os.path.join(Parameters["HomeFolder"], "rtdw_plugin.pstats"),
+                                      "plugin thread", self.__PROFILE_LINES):
+                Domoticz.Log(line)
+        except OSError as err:
+            Domoticz.Error("Cannot save the profile of the plugin thread ({})".format(err))
+        self.__profile = None
+        self.__submit(self.__PRIORITY_POLL, "profile", False)
+
+    ########################################################################################
+    """
+        Bus worker thread. Only this thread touches self.rs485, and it never
+        calls the Domoticz API: everything goes back through self.__results.
+    """
+    def __busWorker(self):
+        try:
+            self.__openBus()
+        except Exception as err:
+            self.__results.put(("link", (False, "cannot open {}: {}".format(Parameters["SerialPort"], err))))
+        profile = None
+        while True:
+            priority, sequence, kind, data = self.__jobs.get()
+            if kind == "stop":
+                break
+            if kind == "profile":
+                profile = self.__profileBus(profile, data)
+                continue
+            try:
+                if self.rs485 is None:
+                    self.__openBus()
+                if kind == "poll":
+                    began = time.perf_counter()
+                    self.__poll(data)
+                    self.__stats.cycle(time.perf_counter() - began)
+                elif kind == "probe":
+                    if self.__baudAuto and self.__port is not None:
+                        self.__probeBaudrate(data)
                     else:
-                        Devices[Unit[0]].Update( 0, str(value))
+                        self.__timed(FrameLabel(data[1], data[0], 1), self.rs485.read_registers, data[0], 1, functioncode=data[1])
+                elif kind == "discover":
+                    if self.__baudAuto and not self.__baudFound and self.__port is not None:
+                        self.__probeBaudrate(self.__PROBE_REGISTER)
+                    self.__results.put(("pcbs", self.__timed(FrameLabel(data[1], data[0], 1), self.rs485.read_register,
+                                                             data[0], functioncode=data[1])))
+                elif kind == "write":
+                    self.__writes(data)
+                if kind != "write":
+                    self.__results.put(("link", (True, None)))
+            except (minimalmodbus.NoResponseError, serial.SerialException) as err:
+                self.__linkLost(kind, err)
+            except minimalmodbus.ModbusException as err:
+                # The RTD-W answered with an exception or a garbled frame: the port stays open
+                self.__results.put(("log", "RTD-W {} refused ({}: {})".format(kind, type(err).__name__, err)))
+                if isinstance(err, minimalmodbus.SlaveReportedException):
+                    if kind == "probe":
+                        self.__results.put(("link", (True, None)))
+                    elif kind == "discover":
+                        # No PCB count: a single unit, as for 32767
+                        self.__results.put(("pcbs", 1))
+            except OSError as err:
+                self.__linkLost(kind, err)
+            except Exception as err:
+                self.__results.put(("error", "Modbus error communicating! check your settings! ({}: {})".format(type(err).__name__, err)))
+                self.__results.put(("debug", traceback.format_exc()))
+            finally:
+                if kind == "poll" or kind == "probe":
+                    self.__results.put(("polled", None))
+                if self.__recorder is not None:
+                    self.__recorder.flush()
+                    if self.__recorder.failed:
+                        self.__results.put(("error", "Frame recording stopped ({})".format(self.__recorder.failed)))
+                        self.__recorder = None
+        self.__closeBus()
+        if self.__recorder is not None:
+            self.__recorder.close()
+
+    def __linkLost(self, kind, err):
+        # The link is down: abort, the plugin thread backs off
+        if not isinstance(err, minimalmodbus.NoResponseError):
+            self.__closeBus()
+        self.__results.put(("link", (False, str(err) or type(err).__name__)))
+        if kind == "write":
+            self.__results.put(("error", "Modbus write not sent: {}".format(err)))
+
+    def __profileBus(self, profile, start):
+        # Profile of the bus worker thread, between the two "profile" jobs
+        if start:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as err:
+                # A single profiler at a time from Python 3.12
+                self.__results.put(("error", "Cannot profile the bus worker ({})".format(err)))
+                return None
+            return profile
+        if profile is not None:
+            profile.disable()
+            try:
+                for line in ProfileReport(profile, os.path.join(Parameters["HomeFolder"], "rtdw_bus.pstats"),
+                                          "bus worker", self.__PROFILE_LINES):
+                    self.__results.put(("log", line))
+            except OSError as err:
+                self.__results.put(("error", "Cannot save the profile of the bus worker ({})".format(err)))
+        return None
+
+    def __probeBaudrate(self, probe):
+        # Fastest rate the RTD-W answers at; a garbled answer is a wrong rate too
+        for baudrate in self.__BAUDRATES:
+            self.__port.baudrate = baudrate
+            try:
+                self.__timed(FrameLabel(probe[1], probe[0], 1), self.rs485.read_registers, probe[0], 1, functioncode=probe[1])
+            except (minimalmodbus.NoResponseError, minimalmodbus.InvalidResponseError):
+                continue
+            except minimalmodbus.SlaveReportedException:
+                # A refusal is an answer at this rate
+                pass
+            self.__baudFound = True
+            if baudrate != self.__baudrate:
+                self.__baudrate = baudrate
+                self.__results.put(("baudrate", baudrate))
+            return
+        self.__port.baudrate = self.__baudrate
+        raise minimalmodbus.NoResponseError("No answer at {} bauds".format(", ".join(str(rate) for rate in self.__BAUDRATES)))
+
+    def __timed(self, label, call, *args, **kwargs):
+        # A Modbus transaction, timed and counted by self.__stats
+        start = time.perf_counter()
+        try:
+            result = call(*args, **kwargs)
+        except Exception as err:
+            self.__stats.transaction(label, time.perf_counter() - start, err)
+            raise
+        self.__stats.transaction(label, time.perf_counter() - start)
+        return result
+
+    def __openBus(self):
+        if Parameters["SerialPort"].startswith(("tcp://", "rtutcp://", "broker://")):
+            self.rs485 = ModbusTCP.fromUrl(Parameters["SerialPort"], int(Parameters["Mode2"]), timeout=1)
+            self.rs485.recorder = self.__recorder
+            return
+        rs485 = minimalmodbus.Instrument(Parameters["SerialPort"], int(Parameters["Mode2"]))
+        rs485.serial.baudrate = self.__baudrate
+        rs485.serial.bytesize = 8
+        rs485.serial.parity = minimalmodbus.serial.PARITY_NONE
+        rs485.serial.stopbits = 1
+        rs485.debug = False
+        rs485.mode = minimalmodbus.MODE_RTU
+        # The turnarounds measured so far are kept when the port is opened again
+        self.__port = rs485.serial
+        if self.__timing is None:
+            self.__timing = SerialTiming(self.__port, self.__TIMEOUT_MIN, self.__TIMEOUT_MAX, self.__TIMING_PERCENTILE,
+                                         self.__TIMING_FACTOR, self.__TIMING_SAMPLES, self.__results.put)
+        else:
+            self.__timing.port = self.__port
+            self.__port.timeout = self.__TIMEOUT_MAX
+        rs485.serial = TimedSerial(rs485.serial, self.__timing)
+        if self.__recorder is not None:
+            rs485.serial = RecordingSerial(rs485.serial, self.__recorder)
+        self.rs485 = rs485
+
+    def __closeBus(self):
+        if self.rs485 is not None:
+            try:
+                if isinstance(self.rs485, ModbusTCP):
+                    self.rs485.close()
                 else:
-                    Domoticz.Debug( "Device {} - {} does not exist".format(Unit[0],self.__UNITS[Unit[0]-1][1]) )
+                    self.rs485.serial.close()
+            except Exception:
+                pass
+            self.rs485 = None
+            self.__port = None
+
+    def __poll(self, plan):
+        # Over TCP the whole plan is sent at once, the gateway queues the frames
+        answers = None
+        if isinstance(self.rs485, ModbusTCP):
+            began = time.perf_counter()
+            try:
+                answers = self.rs485.read_blocks([block[:3] + (min(self.__BROKER_PRIORITIES[register.period] for register, offset in block[3]),)
+                                                  for block in plan])
+            except minimalmodbus.InvalidResponseError as err:
+                # A garbled answer spoils the pipelined ones: read the blocks one by one
+                self.__stats.transaction(FrameLabel(*plan[0][:3]), time.perf_counter() - began, err)
+            except Exception as err:
+                self.__stats.transaction(FrameLabel(*plan[0][:3]), time.perf_counter() - began, err)
+                raise
+            else:
+                # Pipelined frames: each one gets its share of the exchange
+                share = (time.perf_counter() - began) / len(plan)
+                for block, answer in zip(plan, answers):
+                    self.__stats.transaction(FrameLabel(*block[:3]), share, answer if isinstance(answer, Exception) else None)
+        for index, (functioncode, start, count, registers, decoder) in enumerate(plan):
+            if self.__stopping.is_set():
+                return
+            try:
+                if answers is None:
+                    block = self.__timed(FrameLabel(functioncode, start, count), self.rs485.read_registers,
+                                         start, count, functioncode=functioncode)
+                elif isinstance(answers[index], Exception):
+                    raise answers[index]
+                else:
+                    block = answers[index]
+            except minimalmodbus.NoResponseError:
+                raise
+            except minimalmodbus.ModbusException as err:
+                self.__isolate(functioncode, start, count, registers, err)
+                continue
+            self.__results.put(("values", self.__validated(decoder.decode(block))))
+
+    def __isolate(self, functioncode, start, count, registers, err):
+        # A block was refused: read its registers one by one to find the culprit
+        decoded = []
+        refused = []
+        if len(registers) == 1:
+            refused.append(registers[0][0].unit)
         else:
-            Domoticz.Debug( "onHeartbeat - run again in {} heartbeats".format(self.__runAgain) )
+            for register, offset in registers:
+                try:
+                    words = self.__timed(FrameLabel(functioncode, register.address, register.words), self.rs485.read_registers,
+                                         register.address, register.words, functioncode=functioncode)
+                    decoded.extend(BlockDecoder(register.address, register.words, ((register, 0),)).decode(words))
+                except minimalmodbus.NoResponseError:
+                    raise
+                except minimalmodbus.ModbusException:
+                    refused.append(register.unit)
+        self.__results.put(("values", self.__validated(decoded)))
+        self.__results.put(("refused", (refused, "{}: {}".format(type(err).__name__, err))))
+        if len(registers) > 1 and not refused:
+            # Every register read alone: the unused ones in between are refused
+            used = set(register.address + word for register, offset in registers for word in range(register.words))
+            gaps = [address for address in range(start, start + count) if address not in used]
+            if gaps:
+                self.__results.put(("gaps", (functioncode, start, count, gaps)))
+
+    def __validated(self, decoded):
+        # The valid values, the others are posted apart
+        invalid = [entry for entry in decoded if entry[2] is not None]
+        if invalid:
+            self.__results.put(("invalid", invalid))
+        return [(register, value) for register, value, problem in decoded if problem is None]
+
+    def __writes(self, first):
+        # Coalesce the commands queued within the debounce window, last value wins
+        pending = {first[0].address: first}
+        deferred = []
+        start = last = time.time()
+        while True:
+            timeout = min(last + self.__WRITE_WINDOW, start + self.__WRITE_MAX_DELAY) - time.time()
+            if timeout <= 0:
+                break
+            try:
+                job = self.__jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job[2] == "write":
+                pending[job[3][0].address] = job[3]
+                last = time.time()
+            else:
+                deferred.append(job)
+                if job[2] == "stop":
+                    break
+        try:
+            self.__flushWrites(pending)
+        finally:
+            for job in deferred:
+                self.__jobs.put(job)
+
+    def __flushWrites(self, pending):
+        # Runs of adjacent registers, one frame each
+        runs = []
+        for address in sorted(pending):
+            if runs and address == runs[-1][-1] + 1 and len(runs[-1]) < self.__MAX_BLOCK:
+                runs[-1].append(address)
+            else:
+                runs.append([address])
+        accepted = []
+        for run in runs:
+            try:
+                if len(run) == 1:
+                    register, Command, payload = pending[run[0]]
+                    self.__timed("write " + FrameLabel(3, run[0], 1), self.rs485.write_register,
+                                 register.address, payload, number_of_decimals=register.decimals, functioncode=6, signed=register.signed)
+                    self.__results.put(("debug", "write_register n° {}, Payload= {}".format(run[0], payload)))
+                else:
+                    values = [EncodeRegister(pending[address][2], pending[address][0].decimals) for address in run]
+                    self.__timed("write " + FrameLabel(3, run[0], len(run)), self.rs485.write_registers, run[0], values)
+                    self.__results.put(("debug", "write_registers n° {} to {}, Payload= {}".format(run[0], run[-1], values)))
+            except minimalmodbus.NoResponseError:
+                raise
+            except minimalmodbus.ModbusException as err:
+                # Sent and refused: the other runs go on, the link stays up
+                self.__results.put(("error", "RTD-W refused the write of {} ({}: {})".format(
+                    ", ".join("{} to register {}".format(pending[address][2], address) for address in run), type(err).__name__, err)))
+                continue
+            accepted.extend(run)
+
+        # Read back what the RTD-W accepted
+        registers = [pending[address][0] for address in accepted]
+        for functioncode, start, count, block_registers in PlanReads(registers, self.__MAX_GAP, self.__MAX_BLOCK):
+            try:
+                block = self.__timed(FrameLabel(functioncode, start, count), self.rs485.read_registers,
+                                     start, count, functioncode=functioncode)
+            except minimalmodbus.NoResponseError:
+                raise
+            except minimalmodbus.ModbusException as err:
+                self.__results.put(("error", "Cannot read back registers {} to {} after the write ({}: {})".format(
+                    start, start + count - 1, type(err).__name__, err)))
+                continue
+            for register, offset in block_registers:
+                value = DecodeRegister(block[offset:offset + register.words], register.decimals, register.signed)
+                self.__results.put(("written", pending[register.address] + (value,)))
+
+    ########################################################################################
+
+    def __publish(self, register, value, now):
+        nValue, sValue = register.decode(value)
+        for target in register.targets:
+            self.__update(target, nValue, sValue)
+        for Unit, nValue, sValue in self.__metrics.sample(register.unit, now, value):
+            self.__update(Unit, nValue, sValue)
+            self.__batch[ExportName(Unit)] = float(sValue)
+
+    def __save(self, now):
+        # Snapshot for the warm start, replaced in one step
+        path = os.path.join(Parameters["HomeFolder"], self.__SNAPSHOT)
+        snapshot = {
+            "version": self.__SNAPSHOT_VERSION,
+            "equipment": Parameters.get("Mode5") or self.__MAP,
+            "slave": Parameters["Mode2"],
+            "time": now,
+            "pcbs": self.__pcbs,
+            "baudrate": self.__baudrate if self.__baudAuto else None,
+            "health": self.__health.state(),
+            "values": dict((str(Unit), value) for Unit, value in self.__values.items()),
+            }
+        try:
+            with open(path + ".tmp", "w") as handle:
+                json.dump(snapshot, handle)
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            Domoticz.Error("Cannot save {} ({})".format(path, err))
+        self.__savedAt = now
+
+    def __restore(self):
+        # Warm start from the snapshot of the previous run, if it is for the same equipment
+        path = os.path.join(Parameters["HomeFolder"], self.__SNAPSHOT)
+        try:
+            with open(path) as handle:
+                snapshot = json.load(handle)
+            if (snapshot["version"] != self.__SNAPSHOT_VERSION or snapshot["slave"] != Parameters["Mode2"]
+                    or snapshot["equipment"] != (Parameters.get("Mode5") or self.__MAP)):
+                Domoticz.Debug("Snapshot {} is for another configuration".format(path))
+                return
+            # Every field is checked before anything is applied
+            saved = float(snapshot["time"])
+            values = dict((key, (float(read), value)) for key, (read, value) in snapshot["values"].items())
+            now = time.time()
+            if self.__baudAuto and snapshot.get("baudrate"):
+                self.__baudrate = snapshot["baudrate"]
+                self.__baudFound = True
+            self.__discovered(snapshot["pcbs"])
+            self.__health.restore(snapshot["health"], now)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+            Domoticz.Error("Cannot restore {} ({}), cold start".format(path, err))
+            return
+
+        # The devices still show the values of the last run: only changes are updated
+        for Unit in Devices:
+            self.__shadow[Unit] = (Devices[Unit].nValue, Devices[Unit].sValue, Devices[Unit].TimedOut, saved)
+        restored = 0
+        for register in self.__registers:
+            read, value = values.get(str(register.unit), (0, None))
+            if value is None or not now - self.__periods[register.period] < read <= now:
+                continue
+            self.__values[register.unit] = (read, value)
+            self.__publish(register, value, read)
+            self.__due[register.unit] = read + self.__periods[register.period]
+            restored += 1
+        Domoticz.Status("Warm start: {} of {} registers restored from {}".format(restored, len(self.__registers), path))
+
+    def __update(self, Unit, nValue, sValue, TimedOut=0):
+        # Update a device through the shadow cache
+        if Unit not in Devices:
+            return
+        now = time.time()
+        shadow = self.__shadow.get(Unit)
+        if shadow is not None and shadow[2] == TimedOut and now - shadow[3] < self.__REFRESH_MINUTES * 60:
+            if shadow[0] == nValue and shadow[1] == sValue:
+                return
+            if Unit in self.__deadbands and shadow[0] == nValue:
+                try:
+                    # Decimal strings in binary floats: 8.2 - 8.1 is just below 0.1
+                    if abs(float(sValue) - float(shadow[1])) < self.__deadbands[Unit] - 1e-9:
+                        return
+                except ValueError:
+                    pass
+        start = time.perf_counter()
+        UpdateDevice(Unit, nValue, sValue, TimedOut, AlwaysUpdate=True)
+        self.__stats.updated(time.perf_counter() - start)
+        self.__shadow[Unit] = (nValue, sValue, TimedOut, now)
 
     def onMessage(self, Connection, Data):
         Domoticz.Debug("onMessage: {}, {}".format(Connection.Name, Data))
@@ -304,17 +2243,52 @@ class BasePlugin:
             Domoticz.Debugging(1)
         else:
             Domoticz.Debugging(0)
+        if Parameters["Mode6"] == "Profile":
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+            self.__profileBeats = self.__PROFILE_HEARTBEATS
+        if Parameters["Mode6"] == "Record":
+            path = os.path.join(Parameters["HomeFolder"], self.__RECORD_FILE)
+            try:
+                self.__recorder = FrameRecorder(path, self.__RECORD_MAX_MB * 1024 * 1024, self.__RECORD_KEEP)
+                Domoticz.Status("Recording the Modbus frames to {}".format(path))
+            except OSError as err:
+                Domoticz.Error("Cannot record the Modbus frames to {} ({})".format(path, err))
 
         #Code
-        self.rs485 = minimalmodbus.Instrument(Parameters["SerialPort"], int(Parameters["Mode2"]))
-        self.rs485.serial.baudrate = Parameters["Mode1"]
-        self.rs485.serial.bytesize = 8
-        self.rs485.serial.parity = minimalmodbus.serial.PARITY_NONE
-        self.rs485.serial.stopbits = 1
-        self.rs485.serial.timeout = 1
-        self.rs485.debug = False
-            
-        self.rs485.mode = minimalmodbus.MODE_RTU
+        self.rs485 = None
+        Domoticz.Heartbeat(self.__HEARTBEAT)
+        baudrate = Parameters["Mode1"].strip().lower()
+        if baudrate == "auto":
+            self.__baudAuto = True
+        else:
+            try:
+                self.__baudrate = int(baudrate)
+            except ValueError:
+                Domoticz.Error("Invalid baud rate '{}', using {}".format(Parameters["Mode1"], self.__baudrate))
+        try:
+            self.__periods["normal"] = max(1, int(Parameters["Mode3"])) * 60
+        except ValueError:
+            Domoticz.Error("Invalid reading interval '{}', using {} min.".format(Parameters["Mode3"], self.__periods["normal"] // 60))
+
+        # Register map
+        equipment = Parameters.get("Mode5") or self.__MAP
+        if equipment != self.__MAP:
+            try:
+                self.__units, self.__registers, self.__pcbUnits, self.__pcbRegisters = LoadMap(
+                    os.path.join(Parameters["HomeFolder"], "maps", equipment + ".json"))
+                self.__writable = CompileMap(self.__units, self.__registers, self.__periods)
+            except (OSError, ValueError) as err:
+                Domoticz.Error("Cannot load register map '{}' ({}), using {}".format(equipment, err, self.__MAP))
+                self.__units, self.__registers = self.__UNITS, self.__REGISTERS
+                self.__pcbUnits, self.__pcbRegisters = self.__PCB_UNITS, self.__PCB_REGISTERS
+        if self.__units is self.__UNITS:
+            self.__writable = CompileMap(self.__units, self.__registers, self.__periods)
+        self.__names = dict((Unit.unit, Unit.name) for Unit in self.__units)
+        self.__mapRegisters = self.__registers
+
+        # Spread the blocks of each tier over its period, after the first full read
+        self.__setRegisters(self.__registers)
         devicecreated = []
         Domoticz.Log("DAIKIN RTD-W Modbus plugin start")
 
@@ -331,37 +2305,74 @@ class BasePlugin:
 ##        Domoticz.Debug("Image created. ID: " + str(image))
         #
         # Create devices
-        for Unit in self.__UNITS:
-            if Unit[0] not in Devices:
-                if Unit[2] is None:
+        self.__createDevices(self.__units)
+        polled = set(register.unit for register in self.__registers)
+        self.__createDevices([Unit for Unit, sources, deadband in self.__METRIC_UNITS if polled.issuperset(sources)])
+        self.__createDevices(self.__STATS_UNITS)
+        self.__statsSince = self.__savedAt = time.time()
+        #
+        # Log config
+        if Parameters["Mode6"] == "Debug":
+            DumpConfigToLog()
+        #
+        # Values of the last run
+        self.__restore()
+        self.__batch = {}
+        #
+        # Export of the readings
+        if Parameters.get("Mode4"):
+            try:
+                self.__exporter = Exporter(ExportSender(Parameters["Mode4"], "rtdw-{}".format(Parameters["HardwareID"])),
+                                           self.__results.put, os.path.join(Parameters["HomeFolder"], self.__EXPORT_SPILL),
+                                           self.__EXPORT_QUEUE, self.__EXPORT_SPILL_MB * 1024 * 1024, self.__EXPORT_RETRY).start()
+            except ValueError as err:
+                Domoticz.Error("Invalid export '{}' ({})".format(Parameters["Mode4"], err))
+        #
+        # Connection, opened by the bus worker
+        self.__worker = threading.Thread(name="RTD-W bus", target=self.__busWorker)
+        self.__worker.start()
+        if self.__profile is not None:
+            self.__submit(self.__PRIORITY_POLL, "profile", True)
+        self.__submit(self.__PRIORITY_POLL, "discover", self.__PCB_COUNT_REGISTER)
+
+    def __createDevices(self, units):
+        for Unit in units:
+            if Unit.unit not in Devices:
+                if Unit.typeName is None:
                     Domoticz.Device(
-                        Unit=Unit[0],
-                        Name=Unit[1],
-                        Type=Unit[3],
-                        Subtype=Unit[4],
-                        Switchtype=Unit[5],
-                        Options=Unit[6],
-                        Used=Unit[7],
-                        Description=Unit[8]
+                        Unit=Unit.unit,
+                        Name=Unit.name,
+                        Type=Unit.type,
+                        Subtype=Unit.subtype,
+                        Switchtype=Unit.switchtype,
+                        Options=Unit.options,
+                        Used=Unit.used,
+                        Description=Unit.description
                     ).Create()
                 else:
                     Domoticz.Device(
-                        Unit=Unit[0],
-                        Name=Unit[1],
-                        TypeName=Unit[2],
-#                        Switchtype=Unit[5],
-                        Options=Unit[6],
-                        Used=Unit[7],
-                        Description=Unit[8]
+                        Unit=Unit.unit,
+                        Name=Unit.name,
+                        TypeName=Unit.typeName,
+#                        Switchtype=Unit.switchtype,
+                        Options=Unit.options,
+                        Used=Unit.used,
+                        Description=Unit.description
                     ).Create()
-        #
-        # Log config
-        DumpConfigToLog()
-        #
-        # Connection
 
     def onStop(self):
         Domoticz.Debug("onStop")
+        if self.__worker is not None:
+            # Let the queued writes go out, skip the remaining polls
+            self.__stopping.set()
+            self.__submit(self.__PRIORITY_WRITE, "stop", None)
+            self.__worker.join()
+            self.__worker = None
+        if self.__exporter is not None:
+            self.__exporter.stop()
+            self.__exporter = None
+        self.__drainResults()
+        self.__save(time.time())
 
 
 global _plugin
@@ -408,6 +2419,409 @@ def onHeartbeat():
     _plugin.onHeartbeat()
 
 
+################################################################################
+# Modbus helper functions
+################################################################################
+def PlanReads(registers, maxGap, maxBlock, gaps=()):
+    """
+        Group register definitions into block reads.
+        Returns a list of (functioncode, start, count, [(register, offset)]) with
+        the least frames per function code, then the least registers read.
+        gaps holds the (functioncode, address) of unused registers the slave
+        refuses to read: no block spans them.
+    """
+    plan = []
+    for functioncode in sorted(set(register.function for register in registers)):
+        entries = sorted((register for register in registers if register.function == functioncode), key=lambda register: register.address)
+        refused = [any((functioncode, address) in gaps for address in range(entries[k].address + entries[k].words, entries[k + 1].address))
+                   for k in range(len(entries) - 1)]
+        # best[i] = (frames, registers read, first entry of last block) for entries[:i]
+        best = [(0, 0, 0)] + [None] * len(entries)
+        for i in range(1, len(entries) + 1):
+            end = entries[i - 1].address + entries[i - 1].words
+            for j in range(i - 1, -1, -1):
+                start = entries[j].address
+                if end - start > maxBlock:
+                    break
+                if j < i - 1 and (entries[j + 1].address - (start + entries[j].words) > maxGap or refused[j]):
+                    break
+                cost = (best[j][0] + 1, best[j][1] + end - start, j)
+                if best[i] is None or cost[:2] < best[i][:2]:
+                    best[i] = cost
+            if best[i] is None:
+                raise ValueError("Register {} does not fit in a {} registers read".format(entries[i - 1].address, maxBlock))
+        blocks = []
+        i = len(entries)
+        while i > 0:
+            j = best[i][2]
+            start = entries[j].address
+            blocks.append((functioncode, start, entries[i - 1].address + entries[i - 1].words - start,
+                           tuple((register, register.address - start) for register in entries[j:i])))
+            i = j
+        plan.extend(reversed(blocks))
+    return plan
+
+
+def FrameLabel(functioncode, start, count):
+    # I0070-0078 for input registers, H0001 for holding registers, as in the RTD-W manual
+    label = "{}{:04d}".format("H" if functioncode == 3 else "I", start)
+    return label + "-{:04d}".format(start + count - 1) if count > 1 else label
+
+
+def ErrorKind(err):
+    # Kind of a Modbus error in BusStats: crc for a corrupted or invalid answer
+    if isinstance(err, minimalmodbus.NoResponseError):
+        return "timeout"
+    if isinstance(err, minimalmodbus.InvalidResponseError):
+        return "crc"
+    if isinstance(err, minimalmodbus.IllegalRequestError):
+        return "illegal"
+    if isinstance(err, minimalmodbus.SlaveDeviceBusyError):
+        return "busy"
+    return "other"
+
+
+def ProfileReport(profile, path, title, lines):
+    # Save a profile (for pstats or snakeviz) and return its most expensive functions
+    profile.dump_stats(path)
+    report = io.StringIO()
+    pstats.Stats(profile, stream=report).sort_stats("tottime").print_stats(lines)
+    return ["Profile of the {} saved to {}".format(title, path)] + [line for line in report.getvalue().splitlines() if line.strip()]
+
+
+def ExportName(Unit):
+    # Field name of a device in the export
+    return unit(Unit).name if Unit in unit._value2member_map_ else "Unit_{}".format(Unit)
+
+
+def ExportSender(url, clientId):
+    # mqtt://[user:password@]host[:1883]/topic or influx://[user:password@]host[:8086]/database[?measurement=name]
+    parts = urllib.parse.urlsplit(url)
+    path = urllib.parse.unquote(parts.path.lstrip("/"))
+    if not parts.hostname or not path:
+        raise ValueError("host and topic or database needed")
+    if parts.scheme == "mqtt":
+        return MqttSender(parts.hostname, parts.port or 1883, path, parts.username, parts.password, clientId)
+    if parts.scheme == "influx":
+        measurement = urllib.parse.parse_qs(parts.query).get("measurement", ["rtdw"])[0]
+        return InfluxSender(parts.hostname, parts.port or 8086, path, measurement, parts.username, parts.password)
+    raise ValueError("unknown scheme {}".format(parts.scheme))
+
+
+def MqttString(text):
+    data = text.encode()
+    return struct.pack(">H", len(data)) + data
+
+
+def MqttPacket(header, body):
+    # Fixed header with the remaining length (7 bits per byte)
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        digit, length = length % 128, length // 128
+        encoded.append(digit | (0x80 if length else 0))
+        if not length:
+            break
+    return bytes([header]) + bytes(encoded) + body
+
+
+def MqttReceive(connection):
+    # (packet type, body) of the next packet
+    def receive(size):
+        data = b""
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("MQTT connection closed")
+            data += chunk
+        return data
+    header = receive(1)[0]
+    length, shift = 0, 0
+    while True:
+        digit = receive(1)[0]
+        length |= (digit & 0x7F) << shift
+        shift += 7
+        if not digit & 0x80:
+            break
+    return header & 0xF0, receive(length) if length else b""
+
+
+def ReadFrames(path):
+    # (time, direction, framing, frame) of a FrameRecorder file, memory-mapped; a record cut by a crash ends it
+    with open(path, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size < len(FrameRecorder.MAGIC):
+            return
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(FrameRecorder.MAGIC)] != FrameRecorder.MAGIC:
+                raise ValueError("{} is not a frame log".format(path))
+            record = FrameRecorder.RECORD
+            position = len(FrameRecorder.MAGIC)
+            end = len(data)
+            while position + record.size <= end:
+                now, direction, framing, length = record.unpack_from(data, position)
+                position += record.size
+                if position + length > end:
+                    break
+                yield now, direction, framing, data[position:position + length]
+                position += length
+
+
+def FrameExchanges(frames):
+    """
+        Read exchanges of a frame log: (time, functioncode, start, count, answer)
+        with answer the words read, the exception code the slave answered (int)
+        or None when the answer is missing or corrupted. Writes are skipped.
+        RTU answers follow their request, Modbus TCP ones are matched by
+        transaction id.
+    """
+    pending = {}
+    for now, direction, framing, frame in frames:
+        if framing == FrameRecorder.TCP:
+            if len(frame) < 8:
+                continue
+            key, pdu = frame[:2], frame[7:]
+        elif len(frame) < 4 or ModbusCRC(frame[:-2]) != frame[-2:]:
+            # Corrupted or cut by a timeout
+            if direction == FrameRecorder.RESPONSE and None in pending:
+                yield pending.pop(None) + (None,)
+            continue
+        else:
+            key, pdu = None, frame[1:-2]
+        if direction == FrameRecorder.REQUEST:
+            if key in pending:
+                yield pending.pop(key) + (None,)
+            if pdu[0] in (3, 4) and len(pdu) == 5:
+                start, count = struct.unpack(">HH", pdu[1:5])
+                pending[key] = (now, pdu[0], start, count)
+            continue
+        request = pending.pop(key, None)
+        if request is None:
+            continue
+        functioncode, count = request[1], request[3]
+        if pdu[0] == functioncode | 0x80 and len(pdu) >= 2:
+            answer = pdu[1]
+        elif pdu[0] == functioncode and len(pdu) == 2 + 2 * count and pdu[1] == 2 * count:
+            answer = list(struct.unpack(">%dH" % count, pdu[2:]))
+        else:
+            answer = None
+        yield (now,) + request[1:] + (answer,)
+    for request in pending.values():
+        yield request + (None,)
+
+
+def ModbusCRC(frame):
+    # CRC-16/MODBUS, low byte first
+    crc = 0xFFFF
+    for byte in frame:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return struct.pack("<H", crc)
+
+
+def CRCTable():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = CRCTable()
+
+
+def ModbusError(code):
+    # Exception answered by the slave, as minimalmodbus raises it
+    if code == 2:
+        return minimalmodbus.IllegalRequestError("Slave reported illegal data address")
+    if code == 6:
+        return minimalmodbus.SlaveDeviceBusyError("Slave reported device busy")
+    if code == 10 or code == 11:
+        return minimalmodbus.NoResponseError("Gateway reported no answer from the slave (code {})".format(code))
+    return minimalmodbus.SlaveReportedException("Slave reported exception code {}".format(code))
+
+
+def EncodeRegister(value, decimals):
+    """
+        Encode a value as write_register would have done, two's complement when
+        negative.
+    """
+    return int(round(value * 10 ** decimals)) & 0xFFFF
+
+
+def DecodeRegister(words, decimals, signed):
+    """
+        Decode 1 or 2 registers (R high word, R+1 low word) as read_register or
+        read_long would have done.
+    """
+    value = 0
+    for word in words:
+        value = (value << 16) | word
+    if signed and value >= 1 << (16 * len(words) - 1):
+        value -= 1 << (16 * len(words))
+    if decimals:
+        return value / float(10 ** decimals)
+    return value
+
+
+################################################################################
+# Register map functions
+################################################################################
+def DecodeValue(value):
+    return 0, str(value)
+
+
+def DecodeSwitch(value):
+    return int(value != 0), str(value * 100)
+
+
+def DecodeSelector(value):
+    return int(value != 0), str(value * 10)
+
+
+def DecodePulse(value):
+    # Push button, back to Off once the command is written
+    return 0, "0"
+
+
+def DecodeShift(value):
+    # Selector levels 10..110 for -5..+5
+    return int(value != 0), str((value + 6) * 10)
+
+
+def DecodeSource(value):
+    # Selector levels 10..30 for 1:External, 2:Local, 3:On change
+    return int(value != 2), str(value * 10)
+
+
+def DecodeCounter(value):
+    return 0, str(value) + ";0"
+
+
+def Clamp(register, payload):
+    if register.minimum is not None and payload < register.minimum:
+        return register.minimum
+    if register.maximum is not None and payload > register.maximum:
+        return register.maximum
+    return payload
+
+
+def EncodeLevel(register, Command, Level):
+    # Setpoint or switch: On 1, Off 0, else the level within the limits
+    if str(Command) == "On":
+        return 1
+    if str(Command) == "Off":
+        return 0
+    return Clamp(register, int(Level))
+
+
+def EncodeSelector(register, Command, Level):
+    return Clamp(register, int(Level / 10))
+
+
+def EncodeShift(register, Command, Level):
+    return Clamp(register, int((Level / 10) - 6))
+
+
+def EncodeSource(register, Command, Level):
+    payload = int(Level / 10)
+    if payload < register.minimum or payload > register.maximum:
+        payload = 0
+    return payload
+
+
+def EncodeReset(register, Command, Level):
+    # H0012: writing 55555 resets the pump running hours
+    return 55555
+
+
+DECODERS = {
+    "value": DecodeValue,
+    "switch": DecodeSwitch,
+    "selector": DecodeSelector,
+    "pulse": DecodePulse,
+    "shift": DecodeShift,
+    "source": DecodeSource,
+    "counter": DecodeCounter,
+    }
+
+ENCODERS = {
+    "level": EncodeLevel,
+    "selector": EncodeSelector,
+    "shift": EncodeShift,
+    "source": EncodeSource,
+    "reset": EncodeReset,
+    }
+
+
+def LoadMap(path):
+    """
+        Read a register map: a JSON object with the lists "units" and
+        "registers", whose entries have the fields of DeviceDef and RegisterDef,
+        and the optional lists "pcb_units" and "pcb_registers" for PCB 02..16.
+    """
+    with open(path, encoding="utf-8") as mapFile:
+        data = json.load(mapFile)
+    try:
+        units = [DeviceDef(**entry) for entry in data["units"]]
+        registers = [RegisterDef(**entry) for entry in data["registers"]]
+        pcbUnits = [DeviceDef(**entry) for entry in data.get("pcb_units", [])]
+        pcbRegisters = [RegisterDef(**entry) for entry in data.get("pcb_registers", [])]
+    except (KeyError, TypeError) as err:
+        raise ValueError("invalid map: {}".format(err))
+    return units, registers, pcbUnits, pcbRegisters
+
+
+def ExpandPCB(units, registers, pcb, first, size):
+    """
+        Devices and registers of one PCB from the PCB templates: unit index i
+        (0..size-1) becomes device first + i and register offset o (0..99)
+        becomes pcb * 100 + o.
+    """
+    for Unit in units:
+        if not 0 <= Unit.unit < size:
+            raise ValueError("PCB device index {} out of 0..{}".format(Unit.unit, size - 1))
+    for register in registers:
+        if not 0 <= register.address < 100:
+            raise ValueError("PCB register offset {} out of 0..99".format(register.address))
+    pcbUnits = [DeviceDef(first + Unit.unit, "Unité {:02d} - {}".format(pcb, Unit.name), Unit.typeName, Unit.type,
+                          Unit.subtype, Unit.switchtype, Unit.options, Unit.used, Unit.description)
+                for Unit in units]
+    pcbRegisters = [RegisterDef(first + register.unit, pcb * 100 + register.address, register.function,
+                                register.decimals, register.signed, register.words, register.period,
+                                register.decoder, None, register.minimum, register.maximum,
+                                [first + target for target in register.targets], register.deadband,
+                                plausible=register.plausible, rate=register.rate)
+                    for register in registers]
+    return pcbUnits, pcbRegisters
+
+
+def CompileMap(units, registers, periods):
+    """
+        Check a register map and set the decode and encode functions of its
+        registers. Returns the writable registers by device unit.
+    """
+    known = set(Unit.unit for Unit in units)
+    if len(known) != len(units):
+        raise ValueError("duplicate device unit")
+    writable = {}
+    for register in registers:
+        if register.decoder not in DECODERS:
+            raise ValueError("unknown decoder '{}' for register {}".format(register.decoder, register.address))
+        if register.period not in periods:
+            raise ValueError("unknown period '{}' for register {}".format(register.period, register.address))
+        for target in register.targets + register.refresh:
+            if target not in known:
+                raise ValueError("register {} refers to unknown device {}".format(register.address, target))
+        register.decode = DECODERS[register.decoder]
+        if register.encoder is not None:
+            if register.encoder not in ENCODERS or register.function != 3:
+                raise ValueError("invalid encoder '{}' for register {}".format(register.encoder, register.address))
+            register.encode = ENCODERS[register.encoder]
+            writable[register.unit] = register
+    return writable
+
+
 ################################################################################
 # Generic helper functions
 ################################################################################
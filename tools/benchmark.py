@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Poll-cycle benchmark of the plugin against the RTD-W simulator.
+
+    python tools/benchmark.py [--minutes 60] [--transport loop|pty|tcp|rtutcp|broker] [--json out.json]
+
+Scenarios:
+    cold      first heartbeat after onStart, every register read
+    steady    --minutes of virtual time, one heartbeat per Domoticz.Heartbeat period
+    offline   the RTD-W stops answering for --minutes / 4
+    writes    a setpoint slider dragged over 10 steps, then the write settles
+
+For each scenario: Modbus frames (total and per heartbeat), cycle wall time
+(heartbeat until the bus worker is idle), Devices[...].Update calls, CPU of
+the plugin thread per heartbeat and CPU of the whole process.
+With --compare old.json the relative change against a previous run is shown,
+and the exit code is 1 when frames or updates grew by more than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from domoticz_harness import Harness, VirtualClock  # noqa: E402
+from rtdw_simulator import Loopback, PtyServer, RTDWModel, RTDWSimulator, TcpServer  # noqa: E402
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.clock = VirtualClock()
+        self.model = RTDWModel(units=args.units, seed=1)
+        self.simulator = RTDWSimulator(self.model, slaves=[1], latency=args.latency, timeoutRate=args.timeout_rate,
+                                       crcErrorRate=args.crc_error_rate, clock=self.clock.time, seed=1)
+        self.server = None
+        self.pty = None
+        parameters = {"Mode3": str(args.interval)}
+        if args.transport == "pty":
+            self.server = PtyServer(self.simulator).start()
+            parameters["SerialPort"] = self.server.port
+        elif args.transport == "broker":
+            from bus_broker import Broker, SerialBus
+            self.pty = PtyServer(self.simulator).start()
+            self.server = Broker(SerialBus(self.pty.port, timeout=1.0), port=0).start()
+            parameters["SerialPort"] = self.server.url + args.url_options
+        elif args.transport in ("tcp", "rtutcp"):
+            framing = "rtu" if args.transport == "rtutcp" else "tcp"
+            self.server = TcpServer(self.simulator, framing=framing, wireDelay=not args.no_wire_delay).start()
+            parameters["SerialPort"] = self.server.url + args.url_options
+        else:
+            Loopback("loop://rtdw", self.simulator, wireDelay=not args.no_wire_delay)
+            parameters["SerialPort"] = "loop://rtdw"
+        self.harness = Harness(parameters, clock=self.clock, echo=args.verbose)
+        if args.debug:
+            self.harness.Parameters["Mode6"] = "Debug"
+
+    def measure(self, name, heartbeats, before=None):
+        harness = self.harness
+        frames = self.simulator.requests
+        updates = harness.updates
+        cpu = 0.0
+        wall = []
+        process = time.process_time()
+        start = time.perf_counter()
+        for _ in range(heartbeats):
+            if before is not None:
+                before()
+            self.clock.advance(harness.heartbeatSeconds)
+            t0 = time.perf_counter()
+            c0 = time.thread_time()
+            harness.heartbeat()
+            cpu += time.thread_time() - c0
+            polled = self.simulator.requests
+            harness.wait()
+            if self.simulator.requests != polled:
+                wall.append(time.perf_counter() - t0)
+        return {
+            "scenario": name,
+            "heartbeats": heartbeats,
+            "frames": self.simulator.requests - frames,
+            "frames_per_heartbeat": (self.simulator.requests - frames) / float(heartbeats),
+            "cycles": len(wall),
+            "cycle_ms_mean": 1000 * sum(wall) / len(wall) if wall else 0.0,
+            "cycle_ms_max": 1000 * max(wall) if wall else 0.0,
+            "updates": harness.updates - updates,
+            "cpu_us_per_heartbeat": 1e6 * cpu / heartbeats,
+            "process_cpu_ms": 1000 * (time.process_time() - process),
+            "elapsed_s": time.perf_counter() - start,
+        }
+
+    def run(self):
+        harness = self.harness
+        results = []
+        harness.start()
+        harness.wait()
+        heartbeat = harness.heartbeatSeconds
+        results.append(self.measure("cold", 1))
+        results.append(self.measure("steady", int(self.args.minutes * 60 / heartbeat)))
+
+        self.simulator.offline = True
+        results.append(self.measure("offline", max(1, int(self.args.minutes * 15 / heartbeat))))
+        self.simulator.offline = False
+        # Back online: let the probe find the link again
+        for _ in range(200):
+            if harness.plugin._plugin._BasePlugin__health.linkUp:
+                break
+            self.clock.advance(heartbeat)
+            harness.heartbeat()
+            harness.wait()
+
+        frames = self.simulator.requests
+        updates = harness.updates
+        c0 = time.thread_time()
+        for level in range(16, 26):
+            harness.command(6, "Set Level", level)
+            time.sleep(0.05)
+        cpu = time.thread_time() - c0
+        time.sleep(3.5)
+        harness.wait()
+        harness.drain()
+        results.append({
+            "scenario": "writes", "heartbeats": 0, "frames": self.simulator.requests - frames,
+            "frames_per_heartbeat": 0.0, "cycles": 0, "cycle_ms_mean": 0.0, "cycle_ms_max": 0.0,
+            "updates": harness.updates - updates, "cpu_us_per_heartbeat": 1e6 * cpu / 10,
+            "process_cpu_ms": 0.0, "elapsed_s": 0.0,
+        })
+        harness.stop()
+        if self.server is not None:
+            self.server.stop()
+        if self.pty is not None:
+            self.pty.stop()
+        return results
+
+
+def report(results, previous=None):
+    columns = [("scenario", "{:<8}"), ("heartbeats", "{:>10}"), ("frames", "{:>7}"), ("frames_per_heartbeat", "{:>8.2f}"),
+               ("cycle_ms_mean", "{:>9.1f}"), ("cycle_ms_max", "{:>9.1f}"), ("updates", "{:>8}"),
+               ("cpu_us_per_heartbeat", "{:>9.1f}")]
+    print("{:<8} {:>10} {:>7} {:>8} {:>9} {:>9} {:>8} {:>9}".format(
+        "scenario", "heartbeats", "frames", "fr/hb", "cycle ms", "max ms", "updates", "cpu us/hb"))
+    before = {result["scenario"]: result for result in previous or []}
+    for result in results:
+        print(" ".join(fmt.format(result[key]) for key, fmt in columns))
+        old = before.get(result["scenario"])
+        if old:
+            print("{:<8} {:>10} {:>7} {:>8} {:>9} {:>9} {:>8} {:>9}".format(
+                "  vs old", "", change(old["frames"], result["frames"]), "",
+                change(old["cycle_ms_mean"], result["cycle_ms_mean"]), "",
+                change(old["updates"], result["updates"]), change(old["cpu_us_per_heartbeat"], result["cpu_us_per_heartbeat"])))
+
+
+def change(old, new):
+    if not old:
+        return "-"
+    return "{:+.0f}%".format(100.0 * (new - old) / old)
+
+
+def regressions(results, previous, tolerance):
+    before = {result["scenario"]: result for result in previous}
+    found = []
+    for result in results:
+        old = before.get(result["scenario"])
+        for key in ("frames", "updates"):
+            if old and result[key] > old[key] * (1 + tolerance) + 1:
+                found.append("{} {}: {} -> {}".format(result["scenario"], key, old[key], result[key]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll-cycle benchmark against the RTD-W simulator")
+    parser.add_argument("--minutes", type=float, default=60, help="virtual minutes of steady polling")
+    parser.add_argument("--interval", type=int, default=1, help="Reading Interval min. (Mode3)")
+    parser.add_argument("--units", type=int, default=1, help="PCBs on the P1P2 network")
+    parser.add_argument("--transport", choices=("loop", "pty", "tcp", "rtutcp", "broker"), default="loop")
+    parser.add_argument("--url-options", default="", help="appended to the tcp/rtutcp URL, e.g. ?pipeline=1")
+    parser.add_argument("--latency", type=float, default=0.02, help="RTD-W turnaround, seconds")
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--crc-error-rate", type=float, default=0.0)
+    parser.add_argument("--no-wire-delay", action="store_true", help="loop transport without line timing")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of a previous run (--json) to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="allowed growth of frames and updates")
+    parser.add_argument("--debug", action="store_true", help="run the plugin with Debug logging")
+    parser.add_argument("--verbose", action="store_true", help="print the Domoticz log")
+    args = parser.parse_args()
+
+    results = Bench(args).run()
+    previous = None
+    if args.compare:
+        with open(args.compare) as handle:
+            previous = json.load(handle)
+    report(results, previous)
+    if args.json:
+        with open(args.json, "w") as handle:
+            json.dump(results, handle, indent=1)
+    if previous:
+        found = regressions(results, previous, args.tolerance)
+        for line in found:
+            print("REGRESSION " + line)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
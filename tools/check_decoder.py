@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks of the block decoding and of the implausible value filter.
+
+    python tools/check_decoder.py [--blocks 2000] [--seed 1]
+
+blocks      --blocks random read blocks (input or holding registers, 16 or
+            32 bit, signed or not, 0 to 2 decimals, gaps, overlaps, random
+            plausible ranges, words biased towards 0x8000 and the limits)
+            decoded by BlockDecoder must give the values of DecodeRegister,
+            of the same type, and flag exactly the input registers holding
+            0x8000 ("not available") and the values out of range
+            ("implausible").
+spikes      the plugin polls the RTD-W simulator on a virtual clock while the
+            simulator answers 0x8000 for the room temperature, an implausible
+            return temperature, a one-read leaving temperature spike and then
+            a lasting step: only the step may reach the devices, once
+            confirmed by the next read.
+
+The exit code is 1 when a check fails.
+"""
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from domoticz_harness import Harness, VirtualClock  # noqa: E402
+from rtdw_simulator import Loopback, RTDWModel, RTDWSimulator  # noqa: E402
+
+
+def checkBlocks(plugin, blocks, seed):
+    failures = []
+    rng = random.Random(seed)
+    start = 100
+    for _ in range(blocks):
+        registers = []
+        offset = 0
+        while True:
+            words = rng.choice((1, 1, 1, 2))
+            if offset + words > 10:
+                break
+            plausible = None
+            if rng.random() < 0.3:
+                low = rng.uniform(-500, 500)
+                plausible = (low, low + rng.uniform(0, 1000))
+            register = plugin.RegisterDef(1, start + offset, 4 if rng.random() < 0.7 else 3, rng.choice((0, 1, 2)),
+                                          rng.random() < 0.5, words, plausible=plausible)
+            registers.append((register, offset))
+            # Mostly in order, with gaps, sometimes a 32 bit pair overlapped
+            offset += rng.choice((words, words, words + 1, words + 2, 1))
+        if not registers:
+            continue
+        count = max(offset + register.words for register, offset in registers)
+        words = [rng.choice((0, 1, 0x7FFF, 0x8000, 0xFFFF, rng.randrange(0x10000))) for _ in range(count)]
+        decoded = plugin.BlockDecoder(start, count, registers).decode(words)
+        for (register, offset), (decodedRegister, value, problem) in zip(registers, decoded):
+            expected = plugin.DecodeRegister(words[offset:offset + register.words], register.decimals, register.signed)
+            expectedProblem = None
+            if register.words == 1 and register.function == 4 and words[offset] == 0x8000:
+                expectedProblem = "not available"
+            elif register.plausible is not None and not register.plausible[0] <= expected <= register.plausible[1]:
+                expectedProblem = "implausible"
+            if decodedRegister is not register or value != expected or type(value) is not type(expected) \
+                    or problem != expectedProblem:
+                failures.append("block {}: register {} gives {!r} ({}), expected {!r} ({})".format(
+                    words, register.address, value, problem, expected, expectedProblem))
+    return failures
+
+
+def checkSpikes():
+    clock = VirtualClock()
+    model = RTDWModel(units=1, seed=1)
+    simulator = RTDWSimulator(model, slaves=[1], clock=clock.time, seed=1)
+    Loopback("loop://rtdw", simulator, wireDelay=False)
+    harness = Harness({}, clock=clock, keepHistory=True)
+    plugin = harness.plugin
+    unit = plugin.unit
+    address = dict((register.unit, register.address) for register in plugin.BasePlugin._BasePlugin__REGISTERS)
+    room, leaving, back = address[unit.Room_Temp], address[unit.Leaving_Temp], address[unit.Return_Temp]
+    read = model.read
+    state = {"implausible": False, "spikes": 0}
+
+    def faulty(function, register):
+        if function == 4 and register == room:
+            return 0x8000
+        if function == 4 and register == back and state["implausible"]:
+            return 12000
+        if function == 4 and register == leaving and state["spikes"]:
+            state["spikes"] -= 1
+            return 6000
+        return read(function, register)
+
+    model.read = faulty
+
+    def run(seconds):
+        for _ in range(seconds):
+            clock.advance(1)
+            harness.heartbeat()
+            harness.wait()
+
+    def history(Unit):
+        return [sValue for nValue, sValue, timedOut in harness.Devices[int(Unit)].history]
+
+    failures = []
+    harness.start()
+    harness.wait()
+    run(120)
+    state["implausible"] = True
+    run(70)
+    state["implausible"] = False
+    state["spikes"] = 1
+    run(30)
+    single = history(unit.Leaving_Temp)
+    state["spikes"] = 10 ** 6
+    run(60)
+    harness.stop()
+
+    if history(unit.Room_Temp):
+        failures.append("room temperature updated from 0x8000: {}".format(history(unit.Room_Temp)))
+    if "120.0" in history(unit.Return_Temp):
+        failures.append("implausible return temperature 120.0 reached the device")
+    if "60.0" in single:
+        failures.append("a single leaving temperature spike reached the device")
+    if history(unit.Leaving_Temp)[-1] != "60.0":
+        failures.append("lasting leaving temperature step not accepted: {}".format(history(unit.Leaving_Temp)[-4:]))
+    failures.extend("Domoticz error: " + text for text in harness.errors())
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the block decoding and the implausible value filter")
+    parser.add_argument("--blocks", type=int, default=2000, help="random blocks checked against DecodeRegister")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    plugin = Harness({}).plugin
+    failures = checkBlocks(plugin, args.blocks, args.seed)
+    print("blocks {} random blocks, {}".format(args.blocks, "{} failure(s)".format(len(failures)) if failures else "ok"))
+    for text in failures[:20]:
+        print("FAILED " + text)
+    spikes = checkSpikes()
+    print("spikes {}".format("{} failure(s)".format(len(spikes)) if spikes else "ok"))
+    for text in spikes:
+        print("FAILED " + text)
+    return 1 if failures or spikes else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
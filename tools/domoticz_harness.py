@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fake Domoticz module for running plugin.py outside Domoticz.
+
+    Harness(parameters) installs a "Domoticz" module, loads plugin.py as a
+    fresh module and gives it the Devices, Parameters, Settings and Images
+    globals Domoticz would inject. The plugin callbacks are then driven by
+    hand: start(), heartbeat(), command(), stop().
+
+    The plugin clock can be replaced by a VirtualClock so an hour of polling
+    runs in seconds; the bus worker still runs in its own thread, wait() blocks
+    until it has finished the queued work.
+
+    Without a "HomeFolder" parameter the plugin gets a temporary folder of its
+    own (with the maps of the repository), so the files it saves there do not
+    leak from one run to the next.
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import types
+
+PLUGIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plugin.py")
+
+
+class VirtualClock:
+    """ Replacement for the time module of the plugin, advanced by hand """
+
+    def __init__(self, start=1600000000.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Options=None, Used=0,
+                 Description="", Image=0, DeviceID="", **kwargs):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Options = Options or {}
+        self.Used = Used
+        self.Description = Description
+        self.Image = Image
+        self.DeviceID = DeviceID
+        self.ID = 0
+        self.nValue = 0
+        self.sValue = ""
+        self.TimedOut = 0
+        self.LastLevel = 0
+        self.LastUpdate = ""
+        self.updates = 0
+        self.history = []
+        self.harness = None
+
+    def Create(self):
+        harness = Harness.current
+        self.harness = harness
+        self.ID = len(harness.Devices) + 1
+        harness.Devices[self.Unit] = self
+
+    def Update(self, nValue=None, sValue=None, TimedOut=0, Options=None, Image=None, **kwargs):
+        if nValue is not None:
+            self.nValue = nValue
+        if sValue is not None:
+            self.sValue = sValue
+        self.TimedOut = TimedOut
+        if Options is not None:
+            self.Options = Options
+        if Image is not None:
+            self.Image = Image
+        self.updates += 1
+        if self.harness is not None:
+            self.harness.updates += 1
+            if self.harness.keepHistory:
+                self.history.append((self.nValue, self.sValue, self.TimedOut))
+            if self.harness.onUpdate is not None:
+                self.harness.onUpdate(self)
+
+    def Delete(self):
+        del self.harness.Devices[self.Unit]
+
+    def __str__(self):
+        return "Unit: {}, Name: '{}', nValue: {}, sValue: '{}'".format(self.Unit, self.Name, self.nValue, self.sValue)
+
+
+class Harness:
+    """
+        One plugin instance with its fake Domoticz. log keeps (level, text),
+        updates counts the Devices[...].Update calls, onUpdate (when set) is
+        called with the device after each one.
+    """
+
+    current = None
+
+    DEFAULTS = {
+        "SerialPort": "loop://rtdw", "Mode1": "9600", "Mode2": "1", "Mode3": "1",
+        "Mode4": "", "Mode5": "", "Mode6": "Normal",
+        "HardwareID": 1, "HomeFolder": "", "Key": "RTD-W", "Name": "RTD-W", "Address": "", "Port": "",
+        }
+
+    def __init__(self, parameters=None, clock=None, echo=False, keepHistory=False):
+        self.Parameters = dict(self.DEFAULTS)
+        self.Parameters.update(parameters or {})
+        self.home = None
+        if not self.Parameters["HomeFolder"]:
+            self.home = tempfile.TemporaryDirectory(prefix="rtdw-")
+            os.symlink(os.path.join(os.path.dirname(PLUGIN), "maps"), os.path.join(self.home.name, "maps"))
+            self.Parameters["HomeFolder"] = self.home.name + os.sep
+        self.Devices = {}
+        self.Settings = {}
+        self.Images = {}
+        self.log = []
+        self.echo = echo
+        self.debugging = False
+        self.heartbeatSeconds = 10
+        self.keepHistory = keepHistory
+        self.updates = 0
+        self.onUpdate = None
+        self.clock = clock
+        Harness.current = self
+        sys.modules["Domoticz"] = self.domoticzModule()
+        spec = importlib.util.spec_from_file_location("rtdw_plugin", PLUGIN)
+        self.plugin = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.plugin)
+        self.plugin.Devices = self.Devices
+        self.plugin.Parameters = self.Parameters
+        self.plugin.Settings = self.Settings
+        self.plugin.Images = self.Images
+        if clock is not None:
+            self.plugin.time = clock
+
+    def domoticzModule(self):
+        module = types.ModuleType("Domoticz")
+        harness = self
+
+        def logger(level):
+            def log(text):
+                if level == "Debug" and not harness.debugging:
+                    return
+                harness.log.append((level, text))
+                if harness.echo:
+                    print("{:6} {}".format(level, text))
+            return log
+
+        def Debugging(value):
+            harness.debugging = bool(value)
+
+        def Heartbeat(seconds):
+            harness.heartbeatSeconds = seconds
+
+        module.Debug = logger("Debug")
+        module.Log = logger("Log")
+        module.Status = logger("Status")
+        module.Error = logger("Error")
+        module.Debugging = Debugging
+        module.Heartbeat = Heartbeat
+        module.Device = Device
+        module.Devices = self.Devices
+        return module
+
+    # ---------------------------------------------------------------- callbacks
+    def start(self):
+        self.plugin.onStart()
+
+    def stop(self):
+        self.plugin.onStop()
+
+    def heartbeat(self):
+        self.plugin.onHeartbeat()
+
+    def command(self, Unit, Command, Level=0, Hue=""):
+        self.plugin.onCommand(Unit, Command, Level, Hue)
+
+    def idle(self):
+        """ True when the bus worker waits for a job and none is queued """
+        jobs = self.plugin._plugin._BasePlugin__jobs
+        with jobs.mutex:
+            return not jobs.queue and len(jobs.not_empty._waiters) > 0
+
+    def wait(self, timeout=30.0):
+        """ Wait until the bus worker is idle, then apply its results """
+        deadline = time.time() + timeout
+        while not self.idle():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.0005)
+        self.drain()
+        return True
+
+    def drain(self):
+        self.plugin._plugin._BasePlugin__drainResults()
+
+    def errors(self):
+        return [text for level, text in self.log if level == "Error"]
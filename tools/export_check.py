@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Export (Mode4) through a server outage, against the sinks of export_sink.py.
+
+    python tools/export_check.py [--sink mqtt|influx|both] [--minutes 25] [--outage 5] [--units 2]
+
+The plugin polls the RTD-W simulator on a virtual clock and exports to an
+MqttSink or an InfluxSink. After a third of --minutes the sink is taken down
+for --outage minutes, then brought back. Every batch handed to the Exporter is
+noted and at the end the batches received must be the same ones: none lost,
+none duplicated, in order, and the spill file flushed and removed.
+
+The exit code is 1 when a check fails.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from domoticz_harness import Harness, VirtualClock  # noqa: E402
+from export_sink import InfluxSink, MqttSink  # noqa: E402
+from rtdw_simulator import Loopback, RTDWModel, RTDWSimulator  # noqa: E402
+
+
+class Check:
+    def __init__(self, kind, args):
+        self.kind = kind
+        self.args = args
+        self.clock = VirtualClock()
+        self.simulator = RTDWSimulator(RTDWModel(units=args.units, seed=1), slaves=[1], clock=self.clock.time, seed=1)
+        Loopback("loop://rtdw", self.simulator, wireDelay=False)
+        self.sink = (MqttSink() if kind == "mqtt" else InfluxSink()).start()
+        url = self.sink.url + ("/rtdw/hydrobox" if kind == "mqtt" else "/rtdw")
+        self.harness = Harness({"Mode4": url}, clock=self.clock, echo=args.verbose)
+        self.put = []
+
+    def run(self, minutes):
+        for _ in range(int(minutes * 60 / self.harness.heartbeatSeconds)):
+            self.clock.advance(self.harness.heartbeatSeconds)
+            self.harness.heartbeat()
+            self.harness.wait()
+            # Let the export thread catch up, as it would between two heartbeats
+            time.sleep(0.001)
+
+    def received(self):
+        if self.kind == "mqtt":
+            return [batch["time"] for batch in self.sink.batches()]
+        return [int(line.rsplit(" ", 1)[1]) for line in self.sink.lines]
+
+    def check(self):
+        harness = self.harness
+        harness.start()
+        harness.wait()
+        exporter = harness.plugin._plugin._BasePlugin__exporter
+        put = exporter.put
+
+        def noted(now, values):
+            self.put.append(now)
+            put(now, values)
+
+        exporter.put = noted
+        spill = exporter.spillPath
+        before = self.args.minutes / 3
+        self.run(before)
+        self.sink.down()
+        self.run(self.args.outage)
+        spilled = sum(1 for _ in open(spill)) if os.path.exists(spill) else 0
+        self.sink.up()
+        self.run(self.args.minutes - before - self.args.outage)
+        harness.stop()
+
+        # The last message may still be on its way to the sink
+        deadline = time.time() + 5
+        while len(self.received()) < len(self.put) and time.time() < deadline:
+            time.sleep(0.05)
+        self.sink.stop()
+        received = self.received()
+        failures = []
+        if not self.put:
+            failures.append("no batch exported")
+        if not spilled:
+            failures.append("nothing spilled while the sink was down")
+        if os.path.exists(spill):
+            failures.append("spill file not removed after the reconnection")
+        if len(set(received)) != len(received):
+            failures.append("{} duplicated batch(es)".format(len(received) - len(set(received))))
+        if received != sorted(received):
+            failures.append("batches out of order")
+        lost = sorted(set(self.put) - set(received))
+        if lost:
+            failures.append("{} batch(es) lost".format(len(lost)))
+        failures.extend("Domoticz error: " + text for text in harness.errors() if not text.startswith("Export to"))
+        print("{:6} {} batches exported, {} received, {} spilled during the outage{}".format(
+            self.kind, len(self.put), len(received), spilled, "" if failures else ", ok"))
+        for text in failures:
+            print("FAILED " + text)
+        return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export through a server outage against the sink stand-ins")
+    parser.add_argument("--sink", choices=("mqtt", "influx", "both"), default="both")
+    parser.add_argument("--minutes", type=float, default=25, help="virtual minutes of polling")
+    parser.add_argument("--outage", type=float, default=5, help="virtual minutes with the sink down")
+    parser.add_argument("--units", type=int, default=2, help="PCBs on the P1P2 network")
+    parser.add_argument("--verbose", action="store_true", help="print the Domoticz log")
+    args = parser.parse_args()
+
+    kinds = ("mqtt", "influx") if args.sink == "both" else (args.sink,)
+    ok = True
+    for kind in kinds:
+        ok = Check(kind, args).check() and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
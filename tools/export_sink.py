@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stand-ins for the servers the plugin exports to (Export parameter, Mode4).
+
+    MqttSink        MQTT 3.1.1 broker stand-in: accepts connections, acknowledges
+                    the QoS 1 publications and keeps them in messages.
+    InfluxSink      InfluxDB 1.x stand-in: /write requests, the lines of
+                    protocol are kept in lines.
+
+Both listen on localhost (port 0: any free port, see .url) and can be taken
+down and brought back on the same port with down() and up() to check the
+spill file and the flush on reconnection.
+
+Standalone: python tools/export_sink.py [--mqtt 1883] [--influx 8086] prints
+what arrives until Ctrl-C.
+"""
+
+import argparse
+import http.server
+import json
+import socket
+import struct
+import threading
+import time
+
+
+class MqttSink:
+    def __init__(self, port=0, echo=False):
+        self.port = port
+        self.echo = echo
+        self.messages = []  # (topic, payload)
+        self.connections = 0
+        self.listener = None
+        self.thread = None
+        self.clients = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "mqtt://127.0.0.1:{}".format(self.port)
+
+    def start(self):
+        self.up()
+        return self
+
+    def up(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", self.port))
+        self.listener.listen(4)
+        self.listener.settimeout(0.1)
+        self.port = self.listener.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(name="MQTT sink", target=self.serve, daemon=True)
+        self.thread.start()
+
+    def down(self):
+        """ Close the listener and every connection, as a broker restart would """
+        self.running = False
+        self.thread.join()
+        self.listener.close()
+        for client in list(self.clients):
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+        self.clients = []
+
+    stop = down
+
+    def serve(self):
+        while self.running:
+            try:
+                client, address = self.listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.connections += 1
+            self.clients.append(client)
+            threading.Thread(name="MQTT sink client", target=self.client, args=(client,), daemon=True).start()
+
+    def client(self, client):
+        try:
+            while True:
+                kind, body = self.receive(client)
+                if kind == 0x10:
+                    client.sendall(b"\x20\x02\x00\x00")
+                elif kind == 0x30:
+                    length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + length].decode()
+                    qos = (self.header >> 1) & 3
+                    payload = body[2 + length + (2 if qos else 0):]
+                    with self.lock:
+                        self.messages.append((topic, payload))
+                    if self.echo:
+                        print("{} {}".format(topic, payload.decode()))
+                    if qos:
+                        client.sendall(b"\x40\x02" + body[2 + length:4 + length])
+                elif kind == 0xC0:
+                    client.sendall(b"\xd0\x00")
+                elif kind == 0xE0:
+                    break
+        except OSError:
+            pass
+        client.close()
+
+    def receive(self, client):
+        def exactly(size):
+            data = b""
+            while len(data) < size:
+                chunk = client.recv(size - len(data))
+                if not chunk:
+                    raise ConnectionResetError()
+                data += chunk
+            return data
+        self.header = exactly(1)[0]
+        length, shift = 0, 0
+        while True:
+            digit = exactly(1)[0]
+            length |= (digit & 0x7F) << shift
+            shift += 7
+            if not digit & 0x80:
+                break
+        return self.header & 0xF0, exactly(length) if length else b""
+
+    def batches(self):
+        """ Every batch received, the arrays of a flush unpacked """
+        found = []
+        for topic, payload in self.messages:
+            message = json.loads(payload)
+            found.extend(message if isinstance(message, list) else [message])
+        return found
+
+
+class InfluxSink:
+    def __init__(self, port=0, echo=False):
+        self.port = port
+        self.echo = echo
+        self.lines = []
+        self.writes = 0
+        self.clients = []
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return "influx://127.0.0.1:{}".format(self.port)
+
+    def start(self):
+        self.up()
+        return self
+
+    def up(self):
+        sink = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                sink.clients.append(self.connection)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                if not self.path.startswith("/write?"):
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                sink.writes += 1
+                for line in body.splitlines():
+                    sink.lines.append(line)
+                    if sink.echo:
+                        print(line)
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        http.server.ThreadingHTTPServer.allow_reuse_address = True
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(name="InfluxDB sink", target=self.server.serve_forever, args=(0.1,), daemon=True)
+        self.thread.start()
+
+    def down(self):
+        """ Stop listening and close the kept-alive connections """
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        for client in self.clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.clients = []
+
+    stop = down
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MQTT broker and InfluxDB stand-ins for the plugin export")
+    parser.add_argument("--mqtt", type=int, help="MQTT port")
+    parser.add_argument("--influx", type=int, help="InfluxDB HTTP port")
+    args = parser.parse_args()
+    sinks = []
+    if args.mqtt is not None:
+        sinks.append(MqttSink(args.mqtt, echo=True).start())
+    if args.influx is not None:
+        sinks.append(InfluxSink(args.influx, echo=True).start())
+    for sink in sinks:
+        print("Listening on {} (Ctrl-C to stop)".format(sink.url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for sink in sinks:
+        sink.stop()
+
+
+if __name__ == "__main__":
+    main()
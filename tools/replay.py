@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline replay of the Modbus frames recorded by the plugin ("Debug" set to
+"Record frames").
+
+    python tools/replay.py rtdw_frames.bin.1 rtdw_frames.bin [--equipment altherma] [--csv updates.csv] [--unit 5]
+
+The logs are memory-mapped and read in the order given, oldest first. Each read
+exchange is decoded with the register map of the plugin and goes through its
+usual path, as if the bus worker had read it: values drained by the plugin
+thread, deadbands, shadow cache, metrics and Devices[...].Update, on a virtual
+clock set to the time of the frame. Nothing is sent and nothing waits, a day of
+traffic replays in one or two seconds.
+
+--csv writes every device update (time, unit, name, nValue, sValue, timed out):
+the files of two replays of the same log, before and after a change of the
+decoding, can be compared with diff.
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from domoticz_harness import Harness, VirtualClock  # noqa: E402
+
+
+class Replay:
+    def __init__(self, equipment, units=None, writer=None):
+        self.clock = VirtualClock(0)
+        self.harness = Harness({"SerialPort": "tcp://replay", "Mode5": equipment}, clock=self.clock)
+        self.harness.onUpdate = self.updated
+        self.module = self.harness.plugin
+        self.plugin = self.module._plugin
+        self.units = units
+        self.writer = writer
+        self.blocks = {}
+        self.registers = None
+        self.exchanges = 0
+        self.missing = 0
+        self.refused = 0
+        self.values = 0
+
+    def updated(self, device):
+        if self.writer is not None and (not self.units or device.Unit in self.units):
+            self.writer.writerow(["{:.3f}".format(self.clock.now), device.Unit, device.Name,
+                                  device.nValue, device.sValue, device.TimedOut])
+
+    def covered(self, functioncode, start, count):
+        # Decoder of the registers of the map inside a block, the map grows with the PCBs found
+        registers = self.plugin._BasePlugin__registers
+        if registers is not self.registers:
+            self.registers = registers
+            self.blocks = {}
+        key = (functioncode, start, count)
+        decoder = self.blocks.get(key)
+        if decoder is None:
+            decoder = self.blocks[key] = self.module.BlockDecoder(start, count, [
+                (register, register.address - start) for register in registers
+                if register.function == functioncode and start <= register.address
+                and register.address + register.words <= start + count])
+        return decoder
+
+    def run(self, paths):
+        frames = itertools.chain.from_iterable(self.module.ReadFrames(path) for path in paths)
+        exchanges = self.module.FrameExchanges(frames)
+        first = next(exchanges, None)
+        if first is None:
+            return
+        # The bus worker is stopped before it takes its first job: the replay posts the results itself
+        self.clock.now = first[0]
+        self.plugin._BasePlugin__jobs.put((-1, -1, "stop", None))
+        self.harness.start()
+        results = self.plugin._BasePlugin__results
+        pcbCount = self.plugin._BasePlugin__PCB_COUNT_REGISTER
+        for now, functioncode, start, count, answer in itertools.chain([first], exchanges):
+            self.clock.now = now
+            self.exchanges += 1
+            if answer is None:
+                self.missing += 1
+                continue
+            if isinstance(answer, int):
+                self.refused += 1
+                continue
+            if (start, functioncode) == pcbCount:
+                results.put(("pcbs", answer[0]))
+            # Decoded and checked as the bus worker does
+            decoded = self.covered(functioncode, start, count).decode(answer)
+            invalid = [entry for entry in decoded if entry[2] is not None]
+            if invalid:
+                results.put(("invalid", invalid))
+            values = [(register, value) for register, value, problem in decoded if problem is None]
+            self.values += len(values)
+            results.put(("values", values))
+            self.harness.drain()
+        self.harness.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded RTD-W frames through the plugin")
+    parser.add_argument("logs", nargs="+", help="frame logs, oldest first")
+    parser.add_argument("--equipment", default="altherma", help="register map (Equipment parameter)")
+    parser.add_argument("--csv", help="write the device updates to this file")
+    parser.add_argument("--unit", type=int, action="append", help="only these devices in the CSV file")
+    args = parser.parse_args()
+
+    handle = open(args.csv, "w", newline="") if args.csv else None
+    writer = csv.writer(handle) if handle else None
+    if writer is not None:
+        writer.writerow(["time", "unit", "name", "nValue", "sValue", "timedout"])
+    replay = Replay(args.equipment, set(args.unit or []), writer)
+    start = time.perf_counter()
+    replay.run(args.logs)
+    elapsed = time.perf_counter() - start
+    if handle is not None:
+        handle.close()
+
+    print("{} exchanges ({} without answer, {} refused), {} values, {} device updates in {:.2f} s ({:.0f} exchanges/s)".format(
+        replay.exchanges, replay.missing, replay.refused, replay.values, replay.harness.updates, elapsed,
+        replay.exchanges / elapsed if elapsed else 0))
+    for text in replay.harness.errors():
+        print("ERROR " + text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+RTD-W stand-in for running the Domoticz plugin without a hydrobox.
+
+    RTDWModel       the registers of the RTD-W (see the Modbus protocol pages of
+                    the installation instructions) with a crude hydrobox behind
+                    them: compressor cycling, defrost, DHW reheat, pump counter.
+    RTDWSimulator   Modbus RTU slave answering frames from the model, with
+                    configurable turnaround latency and error injection.
+    LoopbackSerial  pyserial look-alike handing frames straight to a simulator,
+                    register it with Loopback(port, simulator) before the plugin
+                    opens the port.
+    PtyServer       serves a simulator on a pseudo-terminal, the plugin (or any
+                    Modbus master) opens PtyServer.port like a real USB adapter.
+    TcpServer       RS485 to Ethernet gateway in front of a simulator, Modbus TCP
+                    or RTU over TCP, the plugin opens TcpServer.url.
+
+Standalone: python tools/rtdw_simulator.py [--latency 0.02] [--timeout-rate 0.01]
+prints the pseudo-terminal to use as "Modbus Port" and serves it until Ctrl-C,
+with --tcp PORT [--framing rtu] it serves a gateway on localhost instead.
+"""
+
+import argparse
+import math
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+import minimalmodbus
+
+
+HOLDING = 3
+INPUT = 4
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+ILLEGAL_VALUE = 3
+SLAVE_BUSY = 6
+
+MAX_REGISTERS = 10  # the RTD-W accepts 1..10 registers per frame
+
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in bytearray(data):
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack("<H", crc)
+
+
+def temperature(value):
+    """ x100 temperature register """
+    return int(round(value * 100)) & 0xFFFF
+
+
+class RTDWModel:
+    """
+        Registers of an RTD-W with a hydrobox behind it. units is the number of
+        PCBs on the P1P2 network (I0020), each with its readback block
+        Ixx00..Ixx47. With strict set, addresses not documented in the manual
+        are refused instead of read as 0.
+        advance(now) moves the hydrobox forward to now (seconds), speed scales
+        the thermal time constants and the hour counter.
+    """
+
+    def __init__(self, units=1, strict=False, speed=1.0, seed=None):
+        self.units = units
+        self.strict = strict
+        self.speed = speed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.commandLag = 3.0
+        self.holding = {
+            1: 45, 2: 18, 3: 1, 4: 1, 5: 21, 6: 0, 7: 0,
+            8: 3, 9: 0, 10: 0, 11: 0, 12: 0,
+            }
+        self.state = {
+            "heating": 1, "pump": 1, "compressor": 0, "disinfection": 0,
+            "setback": 0, "defrost": 0, "reheat": 0, "storage": 0,
+            }
+        self.room = 19.5
+        self.outdoor = 4.0
+        self.leaving = [35.0] * units
+        self.tank = 44.0
+        self.pumpSeconds = 1234 * 3600.0
+        self.compressorSince = 0.0
+        self.compressorRun = 0.0
+        self.defrostUntil = 0.0
+        self.storageUntil = 0.0
+        self.pending = []  # (time, key, value) command effects on the input registers
+        self.now = None
+        self.errors = set()  # (functioncode, address) refused with illegal address
+
+    # ---------------------------------------------------------------- registers
+    def defined(self, functioncode, address):
+        if functioncode == HOLDING:
+            return 1 <= address <= 12
+        if address in (20, 21, 22, 23, 36, 50) or 70 <= address <= 81:
+            return not self.strict or address not in (73, 79)
+        pcb, offset = divmod(address, 100)
+        if 1 <= pcb <= self.units:
+            if self.strict:
+                return offset in (22, 23, 31, 32, 33, 36, 44, 45, 46, 47)
+            return True
+        return False
+
+    def read(self, functioncode, address):
+        if functioncode == HOLDING:
+            return self.holding[address] & 0xFFFF
+        state = self.state
+        if address == 20:
+            return self.units
+        if address == 23:
+            return temperature(sum(self.leaving) / len(self.leaving))
+        if address == 50:
+            return temperature(self.room)
+        if 70 <= address <= 78:
+            key = {70: "heating", 71: "pump", 72: "compressor", 74: "disinfection", 75: "setback",
+                   76: "defrost", 77: "reheat", 78: "storage"}.get(address)
+            return state[key] if key else 0
+        if address in (80, 81):
+            hours = int(self.pumpSeconds // 3600)
+            return (hours >> 16) & 0xFFFF if address == 80 else hours & 0xFFFF
+        pcb, offset = divmod(address, 100)
+        if 1 <= pcb <= self.units:
+            leaving = self.leaving[pcb - 1]
+            if offset == 23:
+                return temperature(leaving)
+            if offset == 31:
+                return temperature(leaving - (5.0 if state["compressor"] else 1.0))
+            if offset == 32:
+                return temperature(self.tank)
+            if offset == 33:
+                return temperature(self.outdoor)
+            if offset == 44:
+                return ord("A")
+            if offset == 45:
+                return ord("H")
+            if offset == 46:
+                return ord("T")
+            if offset == 47:
+                return 16
+        return 0
+
+    def write(self, address, value):
+        now = self.now or 0.0
+        if address == 12 and value == 55555:
+            # The reset code of the pump hours, on the raw word
+            self.pumpSeconds = 0.0
+            self.holding[12] = 0
+            return
+        if value & 0x8000:
+            value -= 0x10000
+        self.holding[address] = value
+        if address == 4:
+            self.pending.append((now + self.commandLag, "heating", int(value != 0)))
+        elif address == 6:
+            self.pending.append((now + self.commandLag, "reheat", int(value != 0)))
+        elif address == 7 and value:
+            self.pending.append((now + self.commandLag, "storage", 1))
+            self.storageUntil = now + self.commandLag + 600
+
+    # ---------------------------------------------------------------- behaviour
+    def advance(self, now):
+        with self.lock:
+            if self.now is None:
+                self.now = now
+                self.compressorSince = now
+            dt = max(0.0, now - self.now) * self.speed
+            self.now = now
+            state = self.state
+            for item in [item for item in self.pending if item[0] <= now]:
+                self.pending.remove(item)
+                state[item[1]] = item[2]
+            if state["storage"] and now >= self.storageUntil:
+                state["storage"] = 0
+                self.holding[7] = 0
+
+            hour = (now / 3600.0) % 24
+            self.outdoor = 4.0 + 5.0 * math.sin((hour - 9) / 24 * 2 * math.pi)
+            state["setback"] = int(hour >= 22 or hour < 6)
+            setpoint = self.holding[5] - (2 if state["setback"] else 0)
+
+            # Compressor cycling with minimum on/off times
+            demand = state["heating"] and self.room < setpoint + 0.5
+            running = now - self.compressorSince
+            if state["compressor"] and (not demand or self.room > setpoint + 0.5) and running > 600:
+                state["compressor"] = 0
+                self.compressorSince = now
+            elif not state["compressor"] and demand and self.room < setpoint - 0.5 and running > 300:
+                state["compressor"] = 1
+                self.compressorSince = now
+
+            # Defrost after an hour of compressor run below 7°C outside
+            if state["defrost"] and now >= self.defrostUntil:
+                state["defrost"] = 0
+            if state["compressor"] and not state["defrost"]:
+                self.compressorRun += dt
+                if self.outdoor < 7 and self.compressorRun > 3600:
+                    state["defrost"] = 1
+                    self.defrostUntil = now + 300 / self.speed
+                    self.compressorRun = 0.0
+
+            target = self.holding[1] if state["compressor"] else self.room + 5
+            if state["defrost"]:
+                target = 15.0
+            k = 1 - math.exp(-dt / 600.0)
+            self.leaving = [leaving + (target + self.random.uniform(-0.05, 0.05) - leaving) * k for leaving in self.leaving]
+            self.room += ((self.leaving[0] - 20) * 0.002 - (self.room - self.outdoor) * 0.0015) * dt / 60.0
+            if state["reheat"]:
+                self.tank += 0.05 * dt / 60.0 * 10
+                if self.tank >= 55:
+                    state["reheat"] = 0
+                    self.holding[6] = 0
+            self.tank -= 0.01 * dt / 60.0
+            state["pump"] = int(state["heating"] or state["reheat"])
+            if state["pump"]:
+                self.pumpSeconds += dt
+
+    # ---------------------------------------------------------------- protocol
+    def request(self, functioncode, address, count=1, values=None):
+        """ Returns (exception code, values) """
+        with self.lock:
+            if functioncode in (HOLDING, INPUT):
+                if not 1 <= count <= MAX_REGISTERS:
+                    return ILLEGAL_VALUE, None
+                addresses = range(address, address + count)
+                if any((functioncode, a) in self.errors or not self.defined(functioncode, a) for a in addresses):
+                    return ILLEGAL_ADDRESS, None
+                return 0, [self.read(functioncode, a) for a in addresses]
+            if functioncode in (6, 16):
+                values = values or []
+                if not 1 <= len(values) <= MAX_REGISTERS:
+                    return ILLEGAL_VALUE, None
+                if any(not self.defined(HOLDING, address + i) for i in range(len(values))):
+                    return ILLEGAL_ADDRESS, None
+                for i, value in enumerate(values):
+                    self.write(address + i, value)
+                return 0, values
+            return ILLEGAL_FUNCTION, None
+
+
+class RTDWSimulator:
+    """
+        Modbus RTU slave. handle(frame) returns the response frame, or None when
+        the slave stays silent (other address, timeout injected, offline).
+            latency        turnaround time of the RTD-W, seconds
+            timeoutRate    probability of not answering
+            crcErrorRate   probability of a corrupted answer
+            busyRate       probability of a "slave busy" exception
+    """
+
+    def __init__(self, model=None, slaves=(1,), latency=0.0, timeoutRate=0.0, crcErrorRate=0.0, busyRate=0.0,
+                 clock=time.time, seed=None):
+        self.model = model if model is not None else RTDWModel()
+        self.models = {}
+        self.slaves = tuple(slaves)
+        self.latency = latency
+        self.timeoutRate = timeoutRate
+        self.crcErrorRate = crcErrorRate
+        self.busyRate = busyRate
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.offline = False
+        self.requests = 0
+        self.responses = 0
+        self.functions = {}
+
+    def modelFor(self, slave):
+        if slave == self.slaves[0]:
+            return self.model
+        if slave not in self.models:
+            self.models[slave] = RTDWModel(units=self.model.units, strict=self.model.strict, speed=self.model.speed)
+        return self.models[slave]
+
+    def handle(self, frame):
+        frame = bytes(frame)
+        if len(frame) < 4 or crc16(frame[:-2]) != frame[-2:]:
+            return None
+        slave, functioncode = frame[0], frame[1]
+        if slave not in self.slaves:
+            return None
+        self.requests += 1
+        self.functions[functioncode] = self.functions.get(functioncode, 0) + 1
+        if self.offline or self.random.random() < self.timeoutRate:
+            return None
+        model = self.modelFor(slave)
+        model.advance(self.clock())
+        if self.random.random() < self.busyRate:
+            return self.exception(slave, functioncode, SLAVE_BUSY)
+        if functioncode in (HOLDING, INPUT) and len(frame) == 8:
+            address, count = struct.unpack(">HH", frame[2:6])
+            code, values = model.request(functioncode, address, count)
+            if code:
+                return self.exception(slave, functioncode, code)
+            body = struct.pack(">BBB", slave, functioncode, 2 * count) + struct.pack(">%dH" % count, *values)
+        elif functioncode == 6 and len(frame) == 8:
+            address, value = struct.unpack(">HH", frame[2:6])
+            code, values = model.request(6, address, values=[value])
+            if code:
+                return self.exception(slave, functioncode, code)
+            body = frame[:6]
+        elif functioncode == 16 and len(frame) >= 9:
+            address, count, size = struct.unpack(">HHB", frame[2:7])
+            values = list(struct.unpack(">%dH" % count, frame[7:7 + size]))
+            code, values = model.request(16, address, values=values)
+            if code:
+                return self.exception(slave, functioncode, code)
+            body = frame[:6]
+        else:
+            return self.exception(slave, functioncode, ILLEGAL_FUNCTION)
+        return self.finish(body)
+
+    def exception(self, slave, functioncode, code):
+        return self.finish(struct.pack(">BBB", slave, functioncode | 0x80, code))
+
+    def finish(self, body):
+        response = body + crc16(body)
+        self.responses += 1
+        if self.random.random() < self.crcErrorRate:
+            response = response[:-1] + bytes([response[-1] ^ 0xFF])
+        return response
+
+
+def requestLength(header):
+    """ Length of an RTU request from its first 7 bytes, None if more are needed """
+    if len(header) < 2:
+        return None
+    if header[1] == 16:
+        return 9 + header[6] if len(header) >= 7 else None
+    return 8
+
+
+class LoopbackSerial:
+    """
+        pyserial look-alike wired to a simulator. With wireDelay the time the
+        frames would take on the line (10 bits per byte at baudrate) and the
+        simulator latency are slept, and a missing or short answer costs the
+        whole timeout, as on a real serial port.
+            With lineBaudrate the simulator only understands frames sent at
+            that rate, others go unanswered (to try the baud rate probe).
+    """
+
+    def __init__(self, simulator, port="loop://rtdw", wireDelay=True, recorder=None, lineBaudrate=None):
+        self.simulator = simulator
+        self.port = port
+        self.wireDelay = wireDelay
+        self.recorder = recorder
+        self.lineBaudrate = lineBaudrate
+        self.baudrate = 9600
+        self.bytesize = 8
+        self.parity = "N"
+        self.stopbits = 1
+        self.timeout = 1.0
+        self.write_timeout = None
+        self.is_open = True
+        self.buffer = b""
+        self.bytesWritten = 0
+        self.bytesRead = 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        self.buffer = b""
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        data = bytes(data)
+        self.bytesWritten += len(data)
+        if self.lineBaudrate is None or self.baudrate == self.lineBaudrate:
+            response = self.simulator.handle(data)
+        else:
+            response = None
+        if self.wireDelay:
+            time.sleep(len(data) * 10.0 / self.baudrate)
+            if response is not None:
+                time.sleep(self.simulator.latency + len(response) * 10.0 / self.baudrate)
+        self.buffer = response or b""
+        return len(data)
+
+    def read(self, size=1):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        if len(data) < size and self.wireDelay and self.timeout:
+            time.sleep(self.timeout)
+        self.bytesRead += len(data)
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+
+def Loopback(port, simulator, wireDelay=True, lineBaudrate=None):
+    """
+        Make minimalmodbus.Instrument(port, ...) use a LoopbackSerial on
+        simulator. Returns the LoopbackSerial.
+    """
+    loop = LoopbackSerial(simulator, port, wireDelay, lineBaudrate=lineBaudrate)
+    minimalmodbus._serialports[port] = loop
+    return loop
+
+
+class PtyServer:
+    """
+        Serve a simulator on a pseudo-terminal pair. port is the device path a
+        Modbus master opens. Frames are delimited by their expected length.
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(name="RTD-W simulator", target=self.serve, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def serve(self):
+        buffer = b""
+        while not self.stopping.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                buffer = b""  # silence: drop a partial frame
+                continue
+            buffer += os.read(self.master, 256)
+            while True:
+                length = requestLength(buffer)
+                if length is None or len(buffer) < length:
+                    break
+                frame, buffer = buffer[:length], buffer[length:]
+                response = self.simulator.handle(frame)
+                if response is not None:
+                    time.sleep(self.simulator.latency)
+                    os.write(self.master, response)
+
+
+class TcpServer:
+    """
+        RS485 to Ethernet gateway stand-in. Requests are queued and answered one
+        at a time, as on the RS485 line behind a gateway: with wireDelay each
+        frame costs its line time at baudrate plus the simulator latency.
+            framing "tcp"  Modbus TCP, a silent slave is reported after
+                           gatewayTimeout with exception 11
+            framing "rtu"  RTU frames over TCP, a silent slave stays silent
+        Several clients can connect, their requests share the line.
+    """
+
+    def __init__(self, simulator, framing="tcp", port=0, wireDelay=True, baudrate=9600, gatewayTimeout=0.5):
+        self.simulator = simulator
+        self.framing = framing
+        self.wireDelay = wireDelay
+        self.baudrate = baudrate
+        self.gatewayTimeout = gatewayTimeout
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", port))
+        self.listener.listen(8)
+        self.listener.settimeout(0.1)
+        self.port = self.listener.getsockname()[1]
+        self.url = "{}://127.0.0.1:{}".format("rtutcp" if framing == "rtu" else "tcp", self.port)
+        self.line = threading.Lock()
+        self.stopping = threading.Event()
+        self.connections = 0
+        self.clients = []
+        self.thread = threading.Thread(name="RTD-W gateway", target=self.serve, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.listener.close()
+        for client in list(self.clients):
+            self.drop(client)
+
+    def drop(self, client):
+        """ Close a client connection, as a gateway restart would """
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.close()
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def serve(self):
+        while not self.stopping.is_set():
+            try:
+                client, address = self.listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            client.settimeout(None)
+            self.connections += 1
+            self.clients.append(client)
+            threading.Thread(name="RTD-W gateway client", target=self.client, args=(client,), daemon=True).start()
+
+    def client(self, client):
+        buffer = b""
+        try:
+            while not self.stopping.is_set():
+                data = client.recv(1024)
+                if not data:
+                    break
+                buffer += data
+                while True:
+                    frame, buffer = self.split(buffer)
+                    if frame is None:
+                        break
+                    response = self.answer(frame)
+                    if response:
+                        client.sendall(response)
+        except OSError:
+            pass
+        self.drop(client)
+
+    def split(self, buffer):
+        if self.framing == "rtu":
+            length = requestLength(buffer)
+        else:
+            length = 6 + struct.unpack(">H", buffer[4:6])[0] if len(buffer) >= 6 else None
+        if length is None or len(buffer) < length:
+            return None, buffer
+        return buffer[:length], buffer[length:]
+
+    def answer(self, frame):
+        if self.framing == "rtu":
+            request = frame
+        else:
+            request = frame[6:] + crc16(frame[6:])
+        with self.line:
+            response = self.simulator.handle(request)
+            if self.wireDelay:
+                time.sleep(len(request) * 10.0 / self.baudrate)
+                if response is not None:
+                    time.sleep(self.simulator.latency + len(response) * 10.0 / self.baudrate)
+                elif self.framing == "tcp":
+                    time.sleep(self.gatewayTimeout)
+        if self.framing == "rtu":
+            return response
+        if response is None:
+            pdu = bytes([frame[6], frame[7] | 0x80, 11])
+        elif crc16(response[:-2]) != response[-2:]:
+            return None  # the gateway drops a corrupted frame
+        else:
+            pdu = response[:-2]
+        return frame[:4] + struct.pack(">H", len(pdu)) + pdu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RTD-W Modbus RTU simulator on a pseudo-terminal")
+    parser.add_argument("--slaves", default="1", help="Modbus addresses answered, comma separated")
+    parser.add_argument("--units", type=int, default=1, help="PCBs on the P1P2 network (I0020)")
+    parser.add_argument("--strict", action="store_true", help="refuse the undocumented addresses")
+    parser.add_argument("--speed", type=float, default=1.0, help="time acceleration of the hydrobox")
+    parser.add_argument("--latency", type=float, default=0.02, help="turnaround time, seconds")
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--crc-error-rate", type=float, default=0.0)
+    parser.add_argument("--busy-rate", type=float, default=0.0)
+    parser.add_argument("--tcp", type=int, help="serve a TCP gateway on this port instead of a pseudo-terminal")
+    parser.add_argument("--framing", choices=("tcp", "rtu"), default="tcp", help="Modbus TCP or RTU over TCP")
+    args = parser.parse_args()
+
+    model = RTDWModel(units=args.units, strict=args.strict, speed=args.speed)
+    simulator = RTDWSimulator(model, slaves=[int(x) for x in args.slaves.split(",")], latency=args.latency,
+                              timeoutRate=args.timeout_rate, crcErrorRate=args.crc_error_rate, busyRate=args.busy_rate)
+    if args.tcp is not None:
+        server = TcpServer(simulator, framing=args.framing, port=args.tcp).start()
+        print("RTD-W simulator on {} (Ctrl-C to stop)".format(server.url))
+    else:
+        server = PtyServer(simulator).start()
+        print("RTD-W simulator on {} (Ctrl-C to stop)".format(server.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    print("{} requests, {} responses, functions {}".format(simulator.requests, simulator.responses, simulator.functions))
+
+
+if __name__ == "__main__":
+    main()